@@ -0,0 +1,485 @@
+"""
+A local stand-in for the parts of the Google Drive API that
+google-drive-to-sqlite uses, serving a synthetic tree of folders and files.
+
+Nothing is stored: every folder and file is derived from its position in the
+tree, so trees of millions of files cost no memory to serve.
+
+Run it on its own with:
+
+    python benchmarks/mock_drive.py --files 100000 --port 8765
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import argparse
+import hashlib
+import httpx
+import json
+import random
+import re
+import threading
+import time
+
+ROOT_ID = "0AMockDriveRootFolder"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+DOCUMENT_MIME_TYPE = "application/vnd.google-apps.document"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def folder_id(index):
+    return "folder-{:012d}".format(index)
+
+
+def file_id(index):
+    return "file-{:014d}".format(index)
+
+
+def user(index):
+    return {
+        "kind": "drive#user",
+        "displayName": "Benchmark User {}".format(index),
+        "photoLink": "https://example.com/photo/{}.png".format(index),
+        "me": index == 0,
+        "permissionId": "{:020d}".format(index),
+        "emailAddress": "user{}@example.com".format(index),
+    }
+
+
+def split_fields(fields):
+    # "nextPageToken, files(id,owners(displayName))" -> top-level names, with
+    # the selection inside files(...) returned separately
+    names, depth, current = [], 0, ""
+    for character in fields + ",":
+        if character == "," and depth == 0:
+            if current.strip():
+                names.append(current.strip())
+            current = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(character, 0)
+        current += character
+    for name in names:
+        if name.startswith("files(") and name.endswith(")"):
+            return split_fields(name[len("files(") : -1])
+    return {name.split("(")[0].split("/")[0] for name in names}
+
+
+class SyntheticDrive:
+    """
+    A tree of ``folders`` folders, each with up to ``branching`` sub-folders,
+    holding ``files`` files spread evenly between them. One in every
+    ``docs_every`` files is a Google Doc, which can only be exported. Files are
+    owned and last modified by a mix of ``users`` different users.
+    """
+
+    def __init__(
+        self,
+        files=10_000,
+        files_per_folder=100,
+        branching=10,
+        file_size=1024,
+        docs_every=10,
+        users=1,
+    ):
+        self.files = files
+        self.folders = max(1, files // files_per_folder)
+        self.branching = branching
+        self.file_size = file_size
+        self.docs_every = docs_every
+        self.users = [user(index) for index in range(users)]
+        # Each file's content is this filler followed by its ID, so checksums
+        # differ between files but only the ID has to be hashed per file
+        self.filler = bytes(range(256)) * (file_size // 256 + 1)
+        self.filler = self.filler[: max(0, file_size - len(file_id(0)))]
+        self.filler_md5 = hashlib.md5(self.filler)
+
+    def __len__(self):
+        return self.folders + self.files
+
+    def item(self, index):
+        # Folders come first, then files
+        if index < self.folders:
+            return self.folder(index)
+        return self.file(index - self.folders)
+
+    def get(self, id):
+        # Returns the metadata for a folder or file ID, or None
+        match = re.match(r"^(folder|file)-(\d+)$", id)
+        if match is None:
+            return None
+        kind, index = match.group(1), int(match.group(2))
+        if kind == "folder" and index < self.folders:
+            return self.folder(index)
+        if kind == "file" and index < self.files:
+            return self.file(index)
+        return None
+
+    def folder_parent(self, index):
+        return ROOT_ID if index == 0 else folder_id((index - 1) // self.branching)
+
+    def folder(self, index):
+        return dict(
+            self.common(index),
+            id=folder_id(index),
+            name="Folder {}".format(index),
+            mimeType=FOLDER_MIME_TYPE,
+            parents=[self.folder_parent(index)],
+            quotaBytesUsed="0",
+        )
+
+    def is_document(self, index):
+        return bool(self.docs_every) and index % self.docs_every == 0
+
+    def file(self, index):
+        file = dict(
+            self.common(index),
+            id=file_id(index),
+            name="File {}.txt".format(index),
+            mimeType="text/plain",
+            parents=[folder_id(index % self.folders)],
+            quotaBytesUsed=str(self.file_size),
+            size=str(self.file_size),
+            md5Checksum=self.md5(index),
+        )
+        if self.is_document(index):
+            file.update(name="Document {}".format(index), mimeType=DOCUMENT_MIME_TYPE)
+            file["quotaBytesUsed"] = "0"
+            del file["size"], file["md5Checksum"]
+        return file
+
+    def common(self, index):
+        timestamp = time.strftime(
+            "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(1_600_000_000 + index * 60)
+        )
+        return {
+            "kind": "drive#file",
+            "starred": False,
+            "trashed": False,
+            "explicitlyTrashed": False,
+            "spaces": ["drive"],
+            "version": "1",
+            "webViewLink": "https://example.com/view",
+            "iconLink": "https://example.com/icon.png",
+            "hasThumbnail": False,
+            "thumbnailVersion": "0",
+            "viewedByMe": True,
+            "createdTime": timestamp,
+            "modifiedTime": timestamp,
+            "modifiedByMe": True,
+            "owners": [self.users[index % len(self.users)]],
+            "lastModifyingUser": self.users[index * 7 % len(self.users)],
+            "shared": False,
+            "ownedByMe": True,
+            "viewersCanCopyContent": True,
+            "copyRequiresWriterPermission": False,
+            "writersCanShare": True,
+            "isAppAuthorized": False,
+        }
+
+    def content(self, index):
+        return self.filler + file_id(index).encode("utf-8")
+
+    def md5(self, index):
+        md5 = self.filler_md5.copy()
+        md5.update(file_id(index).encode("utf-8"))
+        return md5.hexdigest()
+
+    def export(self, index):
+        return "Document {}\n".format(index).encode("utf-8") * 20
+
+    def child_count(self, parent):
+        # Sub-folders of a folder, followed by the files that belong to it
+        if parent == ROOT_ID:
+            return 1
+        match = re.match(r"^folder-(\d+)$", parent)
+        if match is None or int(match.group(1)) >= self.folders:
+            return 0
+        index = int(match.group(1))
+        first = index * self.branching + 1
+        folders = max(0, min(self.folders, first + self.branching) - first)
+        files = max(0, -(-(self.files - index) // self.folders))
+        return folders + files
+
+    def child(self, parent, position):
+        if parent == ROOT_ID:
+            return self.folder(0)
+        index = int(parent.split("-")[1])
+        first = index * self.branching + 1
+        folders = max(0, min(self.folders, first + self.branching) - first)
+        if position < folders:
+            return self.folder(first + position)
+        return self.file(index + (position - folders) * self.folders)
+
+    def list(self, parents=None, offset=0, limit=DEFAULT_PAGE_SIZE):
+        # Returns (files, next_offset), listing everything if parents is None
+        # or the children of each of the parents in turn
+        if parents is None:
+            end = min(len(self), offset + limit)
+            files = [self.item(index) for index in range(offset, end)]
+            return files, (end if end < len(self) else None)
+        files = []
+        position = offset
+        for parent in parents:
+            count = self.child_count(parent)
+            if position >= count:
+                position -= count
+                continue
+            while position < count and len(files) < limit:
+                files.append(self.child(parent, position))
+                position += 1
+            if len(files) == limit:
+                break
+            position = 0
+        next_offset = offset + len(files)
+        total = sum(self.child_count(parent) for parent in parents)
+        return files, (next_offset if next_offset < total else None)
+
+
+class MockDriveHandler(BaseHTTPRequestHandler):
+    # Keep connections alive, as the real API does
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length") or 0)
+        self.rfile.read(length)
+        if self.path.startswith("/oauth2/v4/token"):
+            self.send_json({"access_token": "mock-access-token", "expires_in": 3599})
+        else:
+            self.send_error_json(404, "Not found")
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.throttled():
+            self.send_json(
+                {
+                    "error": {
+                        "code": 429,
+                        "message": "Rate Limit Exceeded",
+                        "errors": [{"reason": "rateLimitExceeded"}],
+                    }
+                },
+                status=429,
+                headers={"Retry-After": str(server.retry_after)},
+            )
+            return
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path
+        if path == "/drive/v3/files":
+            self.list_files(params)
+        elif path == "/drive/v3/changes/startPageToken":
+            self.send_json({"kind": "drive#startPageToken", "startPageToken": "1"})
+        elif path == "/drive/v3/changes":
+            self.send_json(
+                {"kind": "drive#changeList", "newStartPageToken": "1", "changes": []}
+            )
+        elif path.startswith("/drive/v3/files/"):
+            self.get_file(path[len("/drive/v3/files/") :], params)
+        else:
+            self.send_error_json(404, "Not found")
+
+    def list_files(self, params):
+        drive = self.server.drive
+        parents = None
+        if params.get("q"):
+            parents = re.findall(r'"([^"]+)" in parents', params["q"])
+            if not parents:
+                self.send_error_json(400, "Unsupported query: {}".format(params["q"]))
+                return
+        page_size = min(int(params.get("pageSize") or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE)
+        files, next_offset = drive.list(
+            parents, int(params.get("pageToken") or 0), page_size
+        )
+        if params.get("fields"):
+            fields = split_fields(params["fields"])
+            files = [
+                {key: value for key, value in file.items() if key in fields}
+                for file in files
+            ]
+        data = {"kind": "drive#fileList", "incompleteSearch": False, "files": files}
+        if next_offset is not None:
+            data["nextPageToken"] = str(next_offset)
+        self.send_json(data)
+
+    def get_file(self, path, params):
+        drive = self.server.drive
+        id, _, action = path.partition("/")
+        file = drive.get(id)
+        if (
+            file is None
+            or file["mimeType"] == FOLDER_MIME_TYPE
+            and (action or params.get("alt") == "media")
+        ):
+            self.send_error_json(404, "File not found: {}.".format(id))
+            return
+        index = int(id.split("-")[1])
+        if action == "export":
+            if file["mimeType"] != DOCUMENT_MIME_TYPE:
+                self.send_error_json(
+                    403, "Export only supports Docs Editors files.", "fileNotExportable"
+                )
+            else:
+                self.send_body(drive.export(index), "text/plain")
+        elif action:
+            self.send_error_json(404, "Not found")
+        elif params.get("alt") == "media":
+            if file["mimeType"] == DOCUMENT_MIME_TYPE:
+                self.send_error_json(
+                    403,
+                    "Only files with binary content can be downloaded.",
+                    "fileNotDownloadable",
+                )
+            else:
+                self.send_body(drive.content(index), "text/plain")
+        else:
+            if params.get("fields"):
+                fields = split_fields(params["fields"])
+                file = {key: value for key, value in file.items() if key in fields}
+            self.send_json(file)
+
+    def send_error_json(self, status, message, reason="notFound"):
+        self.send_json(
+            {
+                "error": {
+                    "code": status,
+                    "message": message,
+                    "errors": [{"reason": reason, "message": message}],
+                }
+            },
+            status=status,
+        )
+
+    def send_json(self, data, status=200, headers=None):
+        self.send_body(
+            json.dumps(data).encode("utf-8"), "application/json", status, headers
+        )
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockDriveServer(ThreadingHTTPServer):
+    """
+    Serves a SyntheticDrive, sleeping for ``latency`` seconds before each GET
+    and responding to a ``throttle`` fraction of them with a 429 error.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        drive,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        throttle=0.0,
+        retry_after=0,
+        seed=0,
+    ):
+        super().__init__((host, port), MockDriveHandler)
+        self.drive = drive
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def throttled(self):
+        if not self.throttle:
+            return False
+        with self._random_lock:
+            return self._random.random() < self.throttle
+
+
+class MockDriveTransport(httpx.HTTPTransport):
+    "Sends requests meant for the Google APIs to a MockDriveServer instead"
+
+    def __init__(self, url, **kwargs):
+        super().__init__(**kwargs)
+        self.url = httpx.URL(url)
+
+    def handle_request(self, request):
+        request.url = request.url.copy_with(
+            scheme=self.url.scheme, host=self.url.host, port=self.url.port
+        )
+        return super().handle_request(request)
+
+
+def serve(drive_options, server_options, ready=None):
+    # Runs a server until interrupted, putting its URL on the ready queue
+    server = MockDriveServer(SyntheticDrive(**drive_options), **server_options)
+    if ready is not None:
+        ready.put(server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def add_drive_arguments(parser):
+    parser.add_argument("--files", type=int, default=10_000, help="Number of files")
+    parser.add_argument(
+        "--files-per-folder", type=int, default=100, help="Average files per folder"
+    )
+    parser.add_argument(
+        "--branching", type=int, default=10, help="Sub-folders per folder"
+    )
+    parser.add_argument(
+        "--file-size", type=int, default=1024, help="Size of each file in bytes"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds to wait before each GET"
+    )
+    parser.add_argument(
+        "--throttle",
+        type=float,
+        default=0.0,
+        help="Fraction of GET requests to answer with a 429 error",
+    )
+
+
+def drive_options(args):
+    return {
+        "files": args.files,
+        "files_per_folder": args.files_per_folder,
+        "branching": args.branching,
+        "file_size": args.file_size,
+    }
+
+
+def server_options(args):
+    return {"latency": args.latency, "throttle": args.throttle}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    add_drive_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    print(
+        "Serving {:,} files at http://{}:{}/".format(args.files, args.host, args.port)
+    )
+    serve(
+        drive_options(args),
+        dict(server_options(args), host=args.host, port=args.port),
+    )
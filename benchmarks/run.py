@@ -0,0 +1,270 @@
+"""
+Benchmarks for google-drive-to-sqlite, run against a local mock of the
+Google Drive API so that no requests are made to Google.
+
+    python benchmarks/run.py
+    python benchmarks/run.py paginate_files --files 1000000 --latency 0.05
+
+Use --save to record the results and --compare to fail if a later run is
+slower than those saved results by more than --tolerance.
+"""
+
+from click.testing import CliRunner
+from google_drive_to_sqlite import cli, utils
+from time import perf_counter
+from unittest import mock
+import argparse
+import httpx
+import json
+import multiprocessing
+import sys
+
+import mock_drive
+
+BENCHMARKS = {}
+AUTH = {
+    "google-drive-to-sqlite": {
+        "refresh_token": "mock-refresh-token",
+        "google_client_id": "mock-client-id",
+        "google_client_secret": "mock-client-secret",
+    }
+}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def client_class(url, args):
+    # APIClient sending every request to the mock server. The rate limiter
+    # starts at --rate so it does not dominate the timings.
+    class MockDriveAPIClient(utils.APIClient):
+        def __init__(self, *pargs, **kwargs):
+            kwargs.setdefault(
+                "limiter", utils.RateLimiter(rate=args.rate, max_rate=args.rate)
+            )
+            kwargs.setdefault(
+                "transport",
+                mock_drive.MockDriveTransport(
+                    url,
+                    limits=httpx.Limits(
+                        max_connections=max(20, args.concurrency),
+                        max_keepalive_connections=max(20, args.concurrency),
+                    ),
+                ),
+            )
+            super().__init__(*pargs, **kwargs)
+
+    return MockDriveAPIClient
+
+
+def run_cli(url, args, arguments):
+    # Runs a command with --stats, returning the statistics it output
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem(), mock.patch.object(
+        cli, "APIClient", client_class(url, args)
+    ):
+        with open("auth.json", "w") as fp:
+            json.dump(AUTH, fp)
+        result = runner.invoke(cli.cli, arguments + ["--stats"])
+        if result.exit_code != 0:
+            raise RuntimeError(
+                "{} failed: {}".format(arguments[0], result.stderr or result.output)
+            )
+        return json.loads(result.stderr)
+
+
+@benchmark
+def paginate_files(url, args):
+    "List every file in the drive, page by page"
+    client = client_class(url, args)("token", "id", "secret")
+    with client:
+        rows = sum(1 for _ in utils.paginate_files(client, fields=cli.DEFAULT_FIELDS))
+    return rows, client.stats.as_dict()
+
+
+@benchmark
+def files_in_folder_recursive(url, args):
+    "Crawl the folder tree with --concurrency worker threads"
+    client = client_class(url, args)("token", "id", "secret")
+    with client:
+        rows = sum(
+            1
+            for _ in utils.files_in_folder_recursive(
+                client,
+                mock_drive.ROOT_ID,
+                cli.DEFAULT_FIELDS,
+                concurrency=args.concurrency,
+            )
+        )
+    return rows, client.stats.as_dict()
+
+
+@benchmark
+def files(url, args):
+    "google-drive-to-sqlite files, from the first request to the last row saved"
+    stats = run_cli(url, args, ["files", "files.db"])
+    return sum(stats["rows_written"].values()), stats
+
+
+@benchmark
+def download(url, args):
+    "google-drive-to-sqlite download of --downloads files"
+    drive = mock_drive.SyntheticDrive(**mock_drive.drive_options(args))
+    file_ids = [
+        mock_drive.file_id(index)
+        for index in range(drive.files)
+        if not drive.is_document(index)
+    ][: args.downloads]
+    stats = run_cli(
+        url,
+        args,
+        ["download", *file_ids, "-s", "--concurrency", str(args.concurrency)],
+    )
+    return len(file_ids), stats
+
+
+def run(name, url, args):
+    start = perf_counter()
+    rows, stats = BENCHMARKS[name](url, args)
+    seconds = perf_counter() - start
+    return {
+        "benchmark": name,
+        "seconds": round(seconds, 3),
+        "requests": stats["requests"],
+        "requests_per_second": round(stats["requests"] / seconds, 1),
+        "rows": rows,
+        "rows_per_second": round(rows / seconds, 1),
+        "retries": stats["retries"],
+        "bytes_received": stats["bytes_received"],
+        "latency": stats["latency"],
+    }
+
+
+def regressions(results, baseline, tolerance):
+    # Benchmarks whose rows/second fell more than tolerance below the baseline
+    previous = {result["benchmark"]: result for result in baseline["results"]}
+    slower = []
+    for result in results:
+        before = previous.get(result["benchmark"])
+        if before is None:
+            continue
+        if result["rows_per_second"] < before["rows_per_second"] * (1 - tolerance):
+            slower.append((result, before))
+    return slower
+
+
+HEADER = "{:<28}{:>9}{:>10}{:>12}{:>11}{:>12}{:>9}".format(
+    "benchmark", "seconds", "requests", "requests/s", "rows", "rows/s", "retries"
+)
+ROW = (
+    "{benchmark:<28}{seconds:>9.2f}{requests:>10,}{requests_per_second:>12,.1f}"
+    "{rows:>11,}{rows_per_second:>12,.1f}{retries:>9,}"
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n\n")[0],
+        epilog="Benchmarks: {}".format(", ".join(BENCHMARKS)),
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="BENCHMARK",
+        help="Benchmarks to run, defaults to all of them",
+    )
+    mock_drive.add_drive_arguments(parser)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Concurrency for files_in_folder_recursive and download",
+    )
+    parser.add_argument(
+        "--downloads", type=int, default=100, help="Number of files to download"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=10_000.0,
+        help="Requests/second for the client rate limiter, 20 matches the tool",
+    )
+    parser.add_argument(
+        "--url",
+        help="Use an already running mock_drive.py server, started with the "
+        "same --files, --files-per-folder, --branching and --file-size",
+    )
+    parser.add_argument("--save", metavar="PATH", help="Save results as JSON")
+    parser.add_argument(
+        "--compare", metavar="PATH", help="Compare against results saved by --save"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction slower than the --compare results that counts as a regression",
+    )
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("Unknown benchmarks: {}".format(", ".join(sorted(unknown))))
+
+    server = None
+    url = args.url
+    if url is None:
+        # The server gets a process of its own so that it does not compete
+        # with the code being measured for the GIL
+        ready = multiprocessing.Queue()
+        server = multiprocessing.Process(
+            target=mock_drive.serve,
+            args=(
+                mock_drive.drive_options(args),
+                mock_drive.server_options(args),
+                ready,
+            ),
+            daemon=True,
+        )
+        server.start()
+        url = ready.get(timeout=30)
+    try:
+        results = []
+        print(HEADER)
+        for name in args.benchmarks or BENCHMARKS:
+            results.append(run(name, url, args))
+            print(ROW.format(**results[-1]))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    options = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("benchmarks", "url", "save", "compare", "tolerance")
+    }
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump({"options": options, "results": results}, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline["options"] != options:
+            print("Warning: {} used different options".format(args.compare))
+        slower = regressions(results, baseline, args.tolerance)
+        for result, before in slower:
+            print(
+                "Regression: {} {:,.1f} rows/s, was {:,.1f} rows/s".format(
+                    result["benchmark"],
+                    result["rows_per_second"],
+                    before["rows_per_second"],
+                )
+            )
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+Benchmarks for the SQLite write path, feeding synthetic file records straight
+into save_files_and_folders() and into files --import-nl, with no API
+requests involved.
+
+    python benchmarks/write_path.py
+    python benchmarks/write_path.py --sizes 100000,1000000 --batch-sizes 100,1000
+
+Each case runs in a fresh process so that its peak memory use can be
+reported. Use --save and --compare to catch regressions, as with run.py.
+"""
+
+from click.testing import CliRunner
+from google_drive_to_sqlite import cli, utils
+from time import perf_counter
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sqlite_utils
+import sys
+import tempfile
+import traceback
+
+import mock_drive
+from run import regressions
+
+PATHS = ("save_files_and_folders", "import_nl")
+
+
+def records(args, size):
+    # Synthetic records with the fields the files command asks for by default
+    drive = mock_drive.SyntheticDrive(
+        files=size,
+        files_per_folder=args.files_per_folder,
+        branching=args.branching,
+        users=args.users,
+    )
+    fields = set(cli.DEFAULT_FIELDS)
+    for index in range(len(drive)):
+        yield {key: value for key, value in drive.item(index).items() if key in fields}
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def database_size(path):
+    return sum(
+        os.path.getsize(path + suffix)
+        for suffix in ("", "-wal")
+        if os.path.exists(path + suffix)
+    )
+
+
+def measure(path, size, batch_size, args, results):
+    try:
+        results.put(write(path, size, batch_size, args))
+    except Exception:
+        results.put({"error": traceback.format_exc()})
+
+
+def write(path, size, batch_size, args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "files.db")
+        if path == "save_files_and_folders":
+            # Records are built up front, so only the writes are timed
+            items = list(records(args, size))
+            start = perf_counter()
+            db = sqlite_utils.Database(db_path)
+            with utils.bulk_load(db) if args.bulk else contextlib.nullcontext():
+                utils.save_files_and_folders(
+                    db,
+                    items,
+                    batch_size=batch_size,
+                    fields=cli.DEFAULT_FIELDS,
+                    create_indexes=not args.bulk,
+                )
+                if args.bulk:
+                    utils.ensure_indexes(db)
+            rows = len(items)
+        else:
+            nl_path = os.path.join(tmpdir, "files.nl")
+            rows = 0
+            with open(nl_path, "w") as fp:
+                for record in records(args, size):
+                    fp.write(json.dumps(record) + "\n")
+                    rows += 1
+            start = perf_counter()
+            result = CliRunner().invoke(
+                cli.cli,
+                ["files", db_path, "--import-nl", nl_path]
+                + ["--batch-size", str(batch_size)]
+                + (["--bulk"] if args.bulk else []),
+            )
+            if result.exit_code != 0:
+                raise RuntimeError(result.output)
+        seconds = perf_counter() - start
+        return {
+            "benchmark": "{} size={} batch_size={}".format(path, size, batch_size),
+            "seconds": round(seconds, 3),
+            "rows": rows,
+            "rows_per_second": round(rows / seconds, 1),
+            "peak_rss": peak_rss(),
+            "database_size": database_size(db_path),
+        }
+
+
+def run(path, size, batch_size, args):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(
+        target=measure, args=(path, size, batch_size, args, results)
+    )
+    process.start()
+    result = results.get()
+    process.join()
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+def integers(value):
+    return [int(item) for item in value.split(",")]
+
+
+HEADER = "{:<48}{:>9}{:>11}{:>12}{:>10}{:>10}".format(
+    "benchmark", "seconds", "rows", "rows/s", "RSS MB", "DB MB"
+)
+
+
+def format_row(result):
+    return "{:<48}{:>9.2f}{:>11,}{:>12,.1f}{:>10.1f}{:>10.1f}".format(
+        result["benchmark"],
+        result["seconds"],
+        result["rows"],
+        result["rows_per_second"],
+        result["peak_rss"] / 1024 / 1024,
+        result["database_size"] / 1024 / 1024,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        metavar="PATH",
+        help="Write paths to benchmark: {}".format(", ".join(PATHS)),
+    )
+    parser.add_argument(
+        "--sizes",
+        type=integers,
+        default=[10_000, 100_000],
+        help="Comma separated numbers of files",
+    )
+    parser.add_argument(
+        "--batch-sizes",
+        type=integers,
+        default=[100, 1000],
+        help="Comma separated batch sizes",
+    )
+    parser.add_argument(
+        "--files-per-folder", type=int, default=100, help="Average files per folder"
+    )
+    parser.add_argument(
+        "--branching", type=int, default=10, help="Sub-folders per folder"
+    )
+    parser.add_argument(
+        "--users", type=int, default=50, help="Number of different file owners"
+    )
+    parser.add_argument(
+        "--bulk", action="store_true", help="Use the files --bulk database settings"
+    )
+    parser.add_argument("--save", metavar="PATH", help="Save results as JSON")
+    parser.add_argument(
+        "--compare", metavar="PATH", help="Compare against results saved by --save"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction slower than the --compare results that counts as a regression",
+    )
+    args = parser.parse_args(argv)
+    unknown = set(args.paths) - set(PATHS)
+    if unknown:
+        parser.error("Unknown paths: {}".format(", ".join(sorted(unknown))))
+
+    results = []
+    print(HEADER)
+    for path in args.paths or PATHS:
+        for size in args.sizes:
+            for batch_size in args.batch_sizes:
+                results.append(run(path, size, batch_size, args))
+                print(format_row(results[-1]))
+
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump({"results": results}, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        slower = regressions(results, baseline, args.tolerance)
+        for result, before in slower:
+            print(
+                "Regression: {} {:,.1f} rows/s, was {:,.1f} rows/s".format(
+                    result["benchmark"],
+                    result["rows_per_second"],
+                    before["rows_per_second"],
+                )
+            )
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
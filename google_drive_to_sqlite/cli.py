@@ -1,19 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import access
 import click
+import contextlib
+import cProfile
+import hashlib
 import httpx
 import itertools
 import json
+import os
 import pathlib
+import shutil
 import sqlite_utils
+import stat
 import sys
-import textwrap
+import tempfile
+import threading
+import time
 import urllib.parse
 from .utils import (
     APIClient,
+    BLOB_CHUNK_SIZE,
+    bulk_load,
+    CHANGES_PAGE_TOKEN,
+    copy_file_contents,
+    CrawlState,
+    ensure_file_contents_table,
+    ensure_indexes,
+    export_text,
+    FilesError,
+    get_changes_start_page_token,
     get_file,
+    iter_json_array,
+    json_dumps,
+    json_dumps_item,
+    json_loads,
+    get_state,
     files_in_folder_recursive,
+    field_name,
+    files_to_index,
     paginate_files,
+    save_changes,
+    save_file_contents,
+    save_file_text,
     save_files_and_folders,
+    set_state,
+    split_fields,
+    spool,
+    Stats,
 )
 
 # https://github.com/simonw/google-drive-to-sqlite/issues/2
@@ -98,10 +131,59 @@ DEFAULT_FIELDS = [
 ]
 
 
+def resolve_fields(specs, folder=None):
+    # --fields a,b replaces DEFAULT_FIELDS, --fields +a,-b adjusts them
+    # Nested selectors such as owners(displayName,permissionId) are kept
+    # whole, and fields are matched up using their top-level name
+    names = [name for spec in specs for name in split_fields(spec)]
+    if not names:
+        return DEFAULT_FIELDS
+    relative = [name for name in names if name[0] in "+-"]
+    if relative and len(relative) != len(names):
+        raise click.ClickException(
+            "--fields must either all start with + or -, or none of them"
+        )
+    if relative:
+        fields = list(DEFAULT_FIELDS)
+        for name in names:
+            existing = [
+                field for field in fields if field_name(field) == field_name(name[1:])
+            ]
+            if name[0] == "+" and not existing:
+                fields.append(name[1:])
+            elif name[0] == "-":
+                for field in existing:
+                    fields.remove(field)
+    else:
+        fields = list({field_name(name): name for name in names}.values())
+    # These are needed to tell files from folders, and to crawl a folder
+    required = ["id", "mimeType"]
+    if folder:
+        required.append("parents")
+    present = set(map(field_name, fields))
+    return [name for name in required if name not in present] + fields
+
+
 @click.group()
 @click.version_option()
-def cli():
+@click.option(
+    "--profile",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    help="Profile the command with cProfile, writing the stats to this file",
+)
+@click.pass_context
+def cli(ctx, profile):
     "Create a SQLite database of metadata from a Google Drive folder"
+    if profile:
+        # Only the main thread is profiled, not --concurrency worker threads
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def write_profile():
+            profiler.disable()
+            profiler.dump_stats(profile)
+
+        ctx.call_on_close(write_profile)
 
 
 @cli.command()
@@ -199,13 +281,20 @@ def revoke(auth):
     "--nl", is_flag=True, help="Output paginated data as newline-delimited JSON"
 )
 @click.option("--stop-after", type=int, help="Stop paginating after X results")
+@click.option("--fields", help="Only return these fields, e.g. id,name")
+@click.option(
+    "stats_",
+    "--stats",
+    is_flag=True,
+    help="Output request and throughput statistics as JSON to stderr",
+)
 @click.option(
     "-v",
     "--verbose",
     is_flag=True,
     help="Send verbose output to stderr",
 )
-def get(url, auth, paginate, nl, stop_after, verbose):
+def get(url, auth, paginate, nl, stop_after, fields, stats_, verbose):
     "Make an authenticated HTTP GET to the specified URL"
     if not url.startswith("https://www.googleapis.com/"):
         if url.startswith("/"):
@@ -215,13 +304,17 @@ def get(url, auth, paginate, nl, stop_after, verbose):
                 "url must start with / or https://www.googleapis.com/"
             )
 
-    kwargs = load_tokens(auth)
-    if verbose:
-        kwargs["logger"] = lambda s: click.echo(s, err=True)
-    client = APIClient(**kwargs)
+    client = make_client(auth, verbose, stats=make_stats(stats_))
+
+    fields_params = {}
+    if fields:
+        if paginate:
+            # Fields apply to each item, and nextPageToken is needed to paginate
+            fields = "nextPageToken,{}({})".format(paginate, fields)
+        fields_params["fields"] = fields
 
     if not paginate:
-        response = client.get(url)
+        response = client.get(url, params=fields_params or None)
         if verbose:
             click.echo(
                 "{}, headers: {}".format(response.status_code, repr(response.headers))
@@ -241,7 +334,7 @@ def get(url, auth, paginate, nl, stop_after, verbose):
             i = 0
             next_page_token = None
             while True:
-                params = {}
+                params = dict(fields_params)
                 if next_page_token is not None:
                     params["pageToken"] = next_page_token
                 response = client.get(
@@ -270,7 +363,7 @@ def get(url, auth, paginate, nl, stop_after, verbose):
 
         if nl:
             for item in paginate_all():
-                click.echo(json.dumps(item))
+                click.echo(json_dumps(item))
         else:
             for line in stream_indented_json(paginate_all()):
                 click.echo(line)
@@ -290,6 +383,12 @@ def get(url, auth, paginate, nl, stop_after, verbose):
     help="Path to auth.json token file",
 )
 @click.option("--folder", help="Files in this folder ID and its sub-folders")
+@click.option(
+    "--concurrency",
+    type=click.IntRange(1),
+    default=1,
+    help="Number of sub-folder queries to run in parallel with --folder",
+)
 @click.option("-q", help="Files matching this query")
 @click.option("--full-text", help="Search for files with text match")
 @click.option("--starred", is_flag=True, help="Files you have starred")
@@ -323,6 +422,38 @@ def get(url, auth, paginate, nl, stop_after, verbose):
     type=click.Path(file_okay=True, dir_okay=False, allow_dash=True),
     help="Import from this newline-delimited JSON file",
 )
+@click.option(
+    "--fields",
+    multiple=True,
+    help="Comma-separated fields to fetch, or +field/-field to change the defaults",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(1),
+    default=100,
+    help="Number of records to write to the database in each transaction",
+)
+@click.option(
+    "--bulk",
+    is_flag=True,
+    help="Faster, less crash-safe database settings for large imports",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch changes since the last --incremental run",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Resume an interrupted crawl from its last checkpoint",
+)
+@click.option(
+    "stats_",
+    "--stats",
+    is_flag=True,
+    help="Output request and throughput statistics as JSON to stderr",
+)
 @click.option(
     "-v",
     "--verbose",
@@ -333,6 +464,7 @@ def files(
     database,
     auth,
     folder,
+    concurrency,
     q,
     full_text,
     starred,
@@ -348,6 +480,12 @@ def files(
     stop_after,
     import_json,
     import_nl,
+    fields,
+    batch_size,
+    bulk,
+    incremental,
+    resume,
+    stats_,
     verbose,
 ):
     """
@@ -368,9 +506,53 @@ def files(
     Fetch files you have starred:
 
         google-drive-to-sqlite files starred.db --starred
+
+    Use --incremental to fetch everything the first time, then only changes
+    since the previous run on subsequent runs:
+
+        google-drive-to-sqlite files files.db --incremental
+
+    Use --fields to choose which fields to fetch. A list of names replaces the
+    default fields, names starting with + or - are added to or removed from
+    them:
+
+        google-drive-to-sqlite files files.db --fields -owners,-linkShareMetadata
     """
     if not database and not json_ and not nl:
         raise click.ClickException("Must either provide database or use --json or --nl")
+    if incremental and not database:
+        raise click.ClickException("--incremental requires a database")
+    if incremental and any(
+        (
+            folder,
+            q,
+            full_text,
+            starred,
+            trashed,
+            shared_with_me,
+            apps,
+            docs,
+            sheets,
+            presentations,
+            drawings,
+            json_,
+            nl,
+            stop_after,
+            import_json,
+            import_nl,
+        )
+    ):
+        raise click.ClickException(
+            "--incremental cannot be combined with filtering, output or import options"
+        )
+    if resume and (
+        not database or json_ or nl or import_json or import_nl or incremental
+    ):
+        raise click.ClickException(
+            "--resume can only be used when fetching files from the API into a database"
+        )
+    fields = resolve_fields(fields, folder=folder)
+    stats = make_stats(stats_)
     q_bits = []
     if q:
         q_bits.append(q)
@@ -413,10 +595,43 @@ def files(
 
     client = None
     if not (import_json or import_nl):
-        kwargs = load_tokens(auth)
-        if verbose:
-            kwargs["logger"] = lambda s: click.echo(s, err=True)
-        client = APIClient(**kwargs)
+        client = make_client(auth, verbose, stats=stats, concurrency=concurrency)
+
+    if incremental:
+        db = sqlite_utils.Database(database)
+        page_token = get_state(db, CHANGES_PAGE_TOKEN)
+        if page_token is not None:
+            num_changed, num_removed = save_changes(
+                db, client, page_token, fields=fields, stats=stats
+            )
+            if verbose:
+                click.echo(
+                    "{} changed, {} removed".format(num_changed, num_removed), err=True
+                )
+            return
+        # First run: record where the changes feed starts before fetching
+        # everything, so nothing that changes during the crawl is missed
+        start_page_token = get_changes_start_page_token(client)
+
+    # Crawls from the API into a database are checkpointed so they can be resumed
+    state = None
+    if database and client and not (json_ or nl or incremental):
+        db = sqlite_utils.Database(database)
+        params = {"folder": folder, "q": q}
+        if resume:
+            state = CrawlState.load(db)
+        if state is not None:
+            if state.params != params:
+                raise click.ClickException(
+                    "Checkpoint is for a different crawl: {}".format(
+                        json.dumps(state.params)
+                    )
+                )
+            if verbose:
+                click.echo("Resuming from checkpoint", err=True)
+        else:
+            CrawlState.clear(db)
+            state = CrawlState(params)
 
     if import_json or import_nl:
         if "-" in (import_json, import_nl):
@@ -424,23 +639,27 @@ def files(
         else:
             fp = open(import_json or import_nl)
         if import_json:
-            all = json.load(fp)
+            all = iter_json_array(fp)
         else:
 
             def _nl():
                 for line in fp:
                     line = line.strip()
                     if line:
-                        yield json.loads(line)
+                        yield json_loads(line)
 
             all = _nl()
     else:
         if folder:
             all_in_folder = files_in_folder_recursive(
-                client, folder, fields=DEFAULT_FIELDS
+                client,
+                folder,
+                fields=fields,
+                concurrency=concurrency,
+                state=state,
             )
             # Fetch details of that folder first
-            folder_details = get_file(client, folder, fields=DEFAULT_FIELDS)
+            folder_details = get_file(client, folder, fields=fields)
 
             def folder_details_then_all():
                 yield folder_details
@@ -448,7 +667,7 @@ def files(
 
             all = folder_details_then_all()
         else:
-            all = paginate_files(client, q=q, fields=DEFAULT_FIELDS)
+            all = paginate_files(client, q=q, fields=fields, state=state)
 
     if stop_after:
         prev_all = all
@@ -465,7 +684,7 @@ def files(
 
     if nl:
         for file in all:
-            click.echo(json.dumps(file))
+            click.echo(json_dumps(file))
         return
     if json_:
         for line in stream_indented_json(all):
@@ -473,7 +692,31 @@ def files(
         return
 
     db = sqlite_utils.Database(database)
-    save_files_and_folders(db, all)
+    with bulk_load(db) if bulk else contextlib.nullcontext():
+        # With --bulk any missing indexes are built once all rows are loaded
+        counts = save_files_and_folders(
+            db,
+            all,
+            checkpoint=state,
+            batch_size=batch_size,
+            fields=fields,
+            create_indexes=not bulk,
+            stats=stats,
+        )
+        if bulk:
+            ensure_indexes(db)
+    if verbose:
+        click.echo(
+            "{inserted} inserted, {updated} updated, {unchanged} unchanged".format(
+                **counts
+            ),
+            err=True,
+        )
+    if state is not None and not stop_after:
+        # The crawl completed, so there is nothing left to resume
+        CrawlState.clear(db)
+    if incremental:
+        set_state(db, CHANGES_PAGE_TOKEN, start_page_token)
 
 
 def load_tokens(auth):
@@ -488,6 +731,36 @@ def load_tokens(auth):
     }
 
 
+def make_client(auth, verbose=False, stats=None, concurrency=1):
+    kwargs = load_tokens(auth)
+    if verbose:
+        kwargs["logger"] = lambda s: click.echo(s, err=True)
+    # Every worker needs a connection, or those left waiting for one can hit
+    # the pool timeout while the others are busy with long transfers
+    connections = max(20, concurrency)
+    client = APIClient(
+        stats=stats,
+        max_connections=connections,
+        max_keepalive_connections=connections,
+        **kwargs,
+    )
+    # Every request made by the command shares the client's connection pool,
+    # which is closed once the command has finished
+    click.get_current_context().call_on_close(client.close)
+    return client
+
+
+def make_stats(enabled):
+    # Stats are output as JSON when the command finishes, even if it failed
+    if not enabled:
+        return None
+    stats = Stats()
+    click.get_current_context().call_on_close(
+        lambda: click.echo(json.dumps(stats.as_dict(), indent=2), err=True)
+    )
+    return stats
+
+
 @cli.command()
 @click.argument("file_ids", nargs=-1, required=True)
 @click.option(
@@ -509,7 +782,36 @@ def load_tokens(auth):
     is_flag=True,
     help="Hide progress bar and filename",
 )
-def download(file_ids, auth, output, silent):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(1),
+    default=1,
+    help="Number of files to download in parallel",
+)
+@click.option(
+    "--to-db",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    help="Save content to the drive_file_contents table in this database",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, dir_okay=True),
+    help="Reuse files in this directory that have the same md5Checksum",
+)
+@click.option(
+    "--files-db",
+    type=click.Path(file_okay=True, dir_okay=False, exists=True),
+    help="Look up md5Checksum in the drive_files table of this database",
+)
+@click.option(
+    "stats_",
+    "--stats",
+    is_flag=True,
+    help="Output request and throughput statistics as JSON to stderr",
+)
+def download(
+    file_ids, auth, output, silent, concurrency, to_db, cache_dir, files_db, stats_
+):
     """
     Download one or more files to disk, based on their file IDs.
 
@@ -522,18 +824,183 @@ def download(file_ids, auth, output, silent):
     If you are downloading a single file you can specify a filename with -o:
 
         google-drive-to-sqlite download MY_FILE_ID -o myfile.txt
+
+    Use --concurrency to download several files at once:
+
+        google-drive-to-sqlite download ID1 ID2 ID3 --concurrency 3
+
+    Use --to-db to store the content in a SQLite database instead:
+
+        google-drive-to-sqlite download ID1 ID2 --to-db files.db
+
+    Use --cache-dir to keep a copy of each file named after its md5Checksum,
+    and copy unchanged files from there instead of downloading them:
+
+        google-drive-to-sqlite download ID1 ID2 --cache-dir ~/.drive-cache
     """
     if output:
         if len(file_ids) != 1:
             raise click.ClickException("--output option only works with a single file")
-    tokens = load_tokens(auth)
-    client = APIClient(**tokens)
+        if to_db:
+            raise click.ClickException("--output cannot be used with --to-db")
+    if cache_dir and to_db:
+        raise click.ClickException(
+            "--cache-dir cannot be used with --to-db, which reuses stored content"
+        )
+    client = make_client(auth, stats=make_stats(stats_), concurrency=concurrency)
+    if to_db:
+        download_to_db(
+            client, sqlite_utils.Database(to_db), file_ids, concurrency, silent
+        )
+        return
+
+    cache = None
+    if cache_dir:
+        cache = DownloadCache(
+            cache_dir,
+            file_checksums(
+                client, file_ids, sqlite_utils.Database(files_db) if files_db else None
+            ),
+        )
+        file_ids = [
+            file_id for file_id in file_ids if not cache.use(file_id, output, silent)
+        ]
+        if not file_ids:
+            return
+
+    # --output means a single file, which is always downloaded serially
+    if concurrency > 1 and not output:
+        concurrent_download(
+            client,
+            [
+                (
+                    file_id,
+                    "https://www.googleapis.com/drive/v3/files/{}?alt=media".format(
+                        file_id
+                    ),
+                    None,
+                )
+                for file_id in file_ids
+            ],
+            concurrency,
+            silent,
+            on_complete=cache.add if cache else None,
+        )
+        return
     for file_id in file_ids:
         with client.stream(
             "GET",
             "https://www.googleapis.com/drive/v3/files/{}?alt=media".format(file_id),
         ) as response:
-            streaming_download(response, file_id, output, silent)
+            path = streaming_download(response, file_id, output, silent)
+        if cache:
+            cache.add(file_id, path)
+
+
+def file_checksums(client, file_ids, files_db=None):
+    # Returns {file_id: (md5Checksum, mimeType)}, using the drive_files table
+    # of files_db where possible and the API for anything not found there
+    checksums = {}
+    if (
+        files_db is not None
+        and files_db["drive_files"].exists()
+        and "md5Checksum" in files_db["drive_files"].columns_dict
+    ):
+        for file_id, md5_checksum, mime_type in files_db.execute(
+            "select id, md5Checksum, mimeType from drive_files"
+            " where id in (select value from json_each(?))",
+            [json.dumps(list(file_ids))],
+        ):
+            if md5_checksum:
+                checksums[file_id] = (md5_checksum, mime_type)
+    for file_id in file_ids:
+        if file_id not in checksums:
+            file = get_file(client, file_id, fields=["id", "md5Checksum", "mimeType"])
+            checksums[file_id] = (file.get("md5Checksum"), file.get("mimeType"))
+    return checksums
+
+
+class DownloadCache:
+    # A directory of previously downloaded files, each named after its
+    # md5Checksum. Files are copied in and out of it, never linked, so that
+    # writing to a downloaded file cannot change the cached content.
+    def __init__(self, directory, checksums):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.checksums = checksums
+
+    def use(self, file_id, output, silent):
+        # Returns True if file_id was provided from the cache
+        md5_checksum, mime_type = self.checksums[file_id]
+        if not md5_checksum or not (self.directory / md5_checksum).exists():
+            return False
+        cached = self.directory / md5_checksum
+        if file_md5(cached) != md5_checksum:
+            # Damaged cache entry, so download the file again
+            cached.unlink()
+            return False
+        if output == "-":
+            with open(cached, "rb") as fp:
+                shutil.copyfileobj(fp, sys.stdout.buffer)
+            return True
+        filename = output or filename_for_type(mime_type or "/bin", file_id)
+        if os.path.exists(filename) and file_md5(filename) == md5_checksum:
+            message = "{} is unchanged"
+        else:
+            copy_file(cached, filename)
+            message = "Using cached copy of {}"
+        if not silent:
+            click.echo(message.format(filename), err=True)
+        return True
+
+    def add(self, file_id, filename):
+        md5_checksum = self.checksums[file_id][0]
+        # Only cache content that matches the checksum Google Drive reported
+        if filename is None or not md5_checksum or file_md5(filename) != md5_checksum:
+            return
+        copy_file(filename, self.directory / md5_checksum)
+
+
+# The umask can only be read by setting it, so read it once at import time
+# rather than while other threads might be creating files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+@contextlib.contextmanager
+def replacing(path):
+    # Write to a temporary file next to path, then rename it over path. An
+    # existing file at path is replaced rather than truncated, so nothing
+    # else sharing its inode is changed, and a failed write leaves it intact.
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".{}.".format(name))
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            yield fp
+        # mkstemp() creates files readable only by their owner: give the new
+        # file the mode of the file it replaces, or the one open() would use
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~UMASK
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def copy_file(source, destination):
+    with open(source, "rb") as fp, replacing(destination) as out:
+        shutil.copyfileobj(fp, out)
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(BLOB_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 
 @cli.command()
@@ -558,7 +1025,19 @@ def download(file_ids, auth, output, silent):
     is_flag=True,
     help="Hide progress bar and filename",
 )
-def export(format, file_ids, auth, output, silent):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(1),
+    default=1,
+    help="Number of files to export in parallel",
+)
+@click.option(
+    "stats_",
+    "--stats",
+    is_flag=True,
+    help="Output request and throughput statistics as JSON to stderr",
+)
+def export(format, file_ids, auth, output, silent, concurrency, stats_):
     """
     Export one or more files to the specified format.
 
@@ -588,13 +1067,36 @@ def export(format, file_ids, auth, output, silent):
     If you are exporting a single file you can specify a filename with -o:
 
         google-drive-to-sqlite export zip MY_FILE_ID -o myfile.zip
+
+    Use --concurrency to export several files at once:
+
+        google-drive-to-sqlite export pdf ID1 ID2 ID3 --concurrency 3
     """
     format = FORMAT_SHORTCUTS.get(format, format)
     if output:
         if len(file_ids) != 1:
             raise click.ClickException("--output option only works with a single file")
-    tokens = load_tokens(auth)
-    client = APIClient(**tokens)
+    client = make_client(auth, stats=make_stats(stats_), concurrency=concurrency)
+    # --output means a single file, which is always exported serially
+    if concurrency > 1 and not output:
+        concurrent_download(
+            client,
+            [
+                (
+                    "{}-export".format(file_id),
+                    "https://www.googleapis.com/drive/v3/files/{}/export".format(
+                        file_id
+                    ),
+                    {"mimeType": format},
+                )
+                for file_id in file_ids
+            ],
+            concurrency,
+            silent,
+            label="Exporting",
+            show_timings=True,
+        )
+        return
     for file_id in file_ids:
         with client.stream(
             "GET",
@@ -605,25 +1107,98 @@ def export(format, file_ids, auth, output, silent):
             streaming_download(response, filestem, output, silent)
 
 
+@cli.command(name="index-text")
+@click.argument(
+    "database",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@click.option(
+    "-a",
+    "--auth",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True),
+    default="auth.json",
+    help="Path to auth.json token file",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(1),
+    default=1,
+    help="Number of files to export in parallel",
+)
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    help="Send verbose output to stderr",
+)
+def index_text(database, auth, concurrency, verbose):
+    """
+    Export the text of Google Docs, Sheets and Slides in the drive_files table
+    to a drive_file_text table, with full-text search.
+
+        google-drive-to-sqlite index-text files.db
+
+    Docs and Slides are exported as plain text and Sheets as CSV. Only files
+    that have been modified since they were last indexed are exported.
+    """
+    db = sqlite_utils.Database(database)
+    to_index = files_to_index(db)
+    if not to_index:
+        if verbose:
+            click.echo("Nothing to index", err=True)
+        return
+    client = make_client(auth, verbose, concurrency=concurrency)
+    failures = []
+    # Exports happen in parallel, but SQLite writes all happen on this thread
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(export_text, client, file): file for file in to_index
+        }
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                text = future.result()
+            except (FilesError, httpx.HTTPError) as ex:
+                failures.append((file["id"], str(ex)))
+                continue
+            save_file_text(db, file, text)
+    if verbose:
+        click.echo(
+            "Indexed {} of {} files".format(
+                len(to_index) - len(failures), len(to_index)
+            ),
+            err=True,
+        )
+    if failures:
+        for file_id, message in failures:
+            click.echo("Failed {}: {}".format(file_id, message), err=True)
+        raise click.ClickException(
+            "{} of {} files failed".format(len(failures), len(to_index))
+        )
+
+
 def streaming_download(response, filestem, output, silent):
     if response.status_code != 200:
         raise click.ClickException(response.read().decode("utf-8"))
+    # Returns the path that was written to, or None for standard output
     fp = None
+    path = None
     if output:
         filename = pathlib.Path(output).name
         if output == "-":
             fp = sys.stdout.buffer
             silent = True
         else:
-            fp = open(output, "wb")
+            path = output
     else:
-        ext = response.headers.get("content-type", "/bin")
-        if ext in FILE_EXTENSIONS:
-            ext = FILE_EXTENSIONS[ext]
-        else:
-            ext = ext.split("/")[-1]
-        filename = "{}.{}".format(filestem, ext)
-        fp = open(filename, "wb")
+        filename = download_filename(response, filestem)
+        path = filename
+    with replacing(path) if path is not None else contextlib.nullcontext(fp) as fp:
+        write_response(response, fp, filename, silent)
+    return path
+
+
+def write_response(response, fp, filename, silent):
     length = int(response.headers.get("content-length", "0"))
     if not silent:
         click.echo(
@@ -644,6 +1219,228 @@ def streaming_download(response, filestem, output, silent):
             fp.write(data)
 
 
+def download_filename(response, filestem):
+    return filename_for_type(response.headers.get("content-type", "/bin"), filestem)
+
+
+def filename_for_type(content_type, filestem):
+    ext = content_type
+    if ext in FILE_EXTENSIONS:
+        ext = FILE_EXTENSIONS[ext]
+    else:
+        ext = ext.split("/")[-1]
+    return "{}.{}".format(filestem, ext)
+
+
+def concurrent_download(
+    client,
+    downloads,
+    concurrency,
+    silent,
+    label="Downloading",
+    show_timings=False,
+    on_complete=None,
+):
+    # downloads is a list of (filestem, url, params) tuples. Failed downloads
+    # are reported at the end rather than stopping the others. on_complete is
+    # called with (filestem, filename) on this thread for each successful one.
+    lock = threading.Lock()
+    total_bytes = 0
+    start = time.perf_counter()
+
+    def fetch(filestem, url, params):
+        nonlocal total_bytes
+        file_start = time.perf_counter()
+        file_bytes = 0
+        with client.stream("GET", url, params=params) as response:
+            if response.status_code != 200:
+                raise click.ClickException(
+                    "{}: {}".format(
+                        response.status_code, response.read().decode("utf-8")
+                    )
+                )
+            filename = download_filename(response, filestem)
+            with replacing(filename) as fp:
+                for data in response.iter_bytes():
+                    fp.write(data)
+                    file_bytes += len(data)
+                    with lock:
+                        total_bytes += len(data)
+        return filename, file_bytes, time.perf_counter() - file_start
+
+    def progress():
+        elapsed = time.perf_counter() - start
+        return "{:,} bytes, {:.1f} MB/s".format(
+            total_bytes, total_bytes / elapsed / 1_000_000 if elapsed else 0
+        )
+
+    completed = []
+    failures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(fetch, filestem, url, params): filestem
+            for filestem, url, params in downloads
+        }
+        bar = contextlib.nullcontext()
+        if not silent:
+            bar = click.progressbar(
+                length=len(futures),
+                label=label,
+                item_show_func=lambda item: item,
+            )
+        with bar:
+            for future in as_completed(futures):
+                try:
+                    completed.append(future.result())
+                    if on_complete is not None:
+                        on_complete(futures[future], completed[-1][0])
+                except (click.ClickException, httpx.HTTPError) as ex:
+                    message = (
+                        ex.message if isinstance(ex, click.ClickException) else str(ex)
+                    )
+                    failures.append((futures[future], message))
+                if not silent:
+                    bar.update(1, progress())
+    if not silent:
+        if show_timings:
+            for filename, file_bytes, duration in completed:
+                click.echo(
+                    "{}: {:,} bytes in {:.2f}s".format(filename, file_bytes, duration),
+                    err=True,
+                )
+        click.echo(
+            "{} of {} files, {}".format(len(completed), len(downloads), progress()),
+            err=True,
+        )
+    if failures:
+        for filestem, message in failures:
+            click.echo("Failed {}: {}".format(filestem, message), err=True)
+        raise click.ClickException(
+            "{} of {} files failed".format(len(failures), len(downloads))
+        )
+
+
+def download_to_db(client, db, file_ids, concurrency, silent):
+    # With --concurrency files are downloaded in parallel to temporary files,
+    # but SQLite writes all happen on this thread. Content that is already
+    # stored with the same md5Checksum is reused rather than downloaded again.
+    ensure_file_contents_table(db)
+    stored = dict(db.execute("select id, md5Checksum from drive_file_contents"))
+    by_checksum = {md5_checksum: file_id for file_id, md5_checksum in stored.items()}
+
+    def metadata(file_id):
+        file = get_file(client, file_id, fields=["id", "size", "md5Checksum"])
+        if "error" in file:
+            raise click.ClickException("{}: {}".format(file_id, file["error"]))
+        size = file.get("size")
+        return (int(size) if size is not None else None), file.get("md5Checksum")
+
+    @contextlib.contextmanager
+    def content(file_id):
+        with client.stream(
+            "GET",
+            "https://www.googleapis.com/drive/v3/files/{}?alt=media".format(file_id),
+        ) as response:
+            if response.status_code != 200:
+                raise click.ClickException(
+                    "{}: {}".format(file_id, response.read().decode("utf-8"))
+                )
+            yield response.iter_bytes(BLOB_CHUNK_SIZE)
+
+    def fetch(file_id):
+        size, md5_checksum = metadata(file_id)
+        if md5_checksum in by_checksum:
+            return file_id, size, md5_checksum, None
+        with content(file_id) as chunks:
+            fp, _, _ = spool(chunks)
+        return file_id, size, md5_checksum, fp
+
+    def reuse(file_id, md5_checksum):
+        # Returns True if the content did not need to be downloaded
+        if md5_checksum not in by_checksum:
+            return False
+        if stored.get(file_id) != md5_checksum:
+            with db.conn:
+                copy_file_contents(db, by_checksum[md5_checksum], file_id)
+            client.stats.rows_written("drive_file_contents", 1)
+        return True
+
+    def saved(file_id, md5_checksum):
+        stored[file_id] = md5_checksum
+        by_checksum[md5_checksum] = file_id
+        client.stats.rows_written("drive_file_contents", 1)
+
+    bar = contextlib.nullcontext()
+    if not silent:
+        bar = click.progressbar(
+            length=len(file_ids), label="Downloading", item_show_func=lambda item: item
+        )
+    with bar:
+        if concurrency <= 1:
+            for file_id in file_ids:
+                size, md5_checksum = metadata(file_id)
+                if not reuse(file_id, md5_checksum):
+                    with content(file_id) as chunks:
+                        md5_checksum = save_db_contents(
+                            db, file_id, chunks, size, md5_checksum
+                        )
+                    saved(file_id, md5_checksum)
+                if not silent:
+                    bar.update(1, file_id)
+            return
+        # Failures are reported at the end rather than stopping the others
+        failures = []
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = {executor.submit(fetch, file_id): file_id for file_id in file_ids}
+        try:
+            for future in as_completed(list(futures)):
+                file_id = futures.pop(future)
+                try:
+                    file_id, size, md5_checksum, fp = future.result()
+                    if fp is None:
+                        reuse(file_id, md5_checksum)
+                    else:
+                        with fp:
+                            md5_checksum = save_db_contents(
+                                db,
+                                file_id,
+                                iter(lambda: fp.read(BLOB_CHUNK_SIZE), b""),
+                                size,
+                                md5_checksum,
+                            )
+                        saved(file_id, md5_checksum)
+                except click.ClickException as ex:
+                    failures.append(ex.message)
+                except httpx.HTTPError as ex:
+                    failures.append("{}: {}".format(file_id, ex))
+                if not silent:
+                    bar.update(1, file_id)
+        finally:
+            # After an unexpected error, close the spooled files of downloads
+            # that were never saved
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    fp = future.result()[3]
+                    if fp is not None:
+                        fp.close()
+    if failures:
+        for message in failures:
+            click.echo("Failed {}".format(message), err=True)
+        raise click.ClickException(
+            "{} of {} files failed".format(len(failures), len(file_ids))
+        )
+
+
+def save_db_contents(db, file_id, chunks, size, md5_checksum):
+    try:
+        return save_file_contents(db, file_id, chunks, size, md5_checksum)
+    except FilesError as ex:
+        raise click.ClickException(str(ex))
+
+
 def stream_indented_json(iterator, indent=2):
     # We have to iterate two-at-a-time so we can know if we
     # should output a trailing comma or if we have reached
@@ -656,9 +1453,7 @@ def stream_indented_json(iterator, indent=2):
         data = item
         line = "{first}{serialized}{separator}{last}".format(
             first="[\n" if first else "",
-            serialized=textwrap.indent(
-                json.dumps(data, indent=indent, default=repr), " " * indent
-            ),
+            serialized=json_dumps_item(data, indent=indent),
             separator="," if not is_last else "",
             last="\n]" if is_last else "",
         )
@@ -1,8 +1,81 @@
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+import asyncio
 import click
+import collections
+import hashlib
 import httpx
 import itertools
-from time import sleep
+import json
+import queue
+import random
+import re
+import tempfile
+from sqlite_utils.utils import suggest_column_types
+import threading
+from time import monotonic, sleep
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# Longest '"a" in parents or "b" in parents ...' query to send in one request,
+# keeping request URLs well within the limits accepted by the Drive API
+MAX_PARENTS_QUERY_LENGTH = 2000
+# drive_state key for the changes feed page token used by files --incremental
+CHANGES_PAGE_TOKEN = "changes_page_token"
+# drive_state key for the checkpoint used by files --resume
+CHECKPOINT = "checkpoint"
+# Google Apps files that can be exported as text, and the format to use
+TEXT_EXPORT_FORMATS = {
+    "application/vnd.google-apps.document": "text/plain",
+    "application/vnd.google-apps.presentation": "text/plain",
+    "application/vnd.google-apps.spreadsheet": "text/csv",
+}
+# Record keys that are saved to a differently named column
+RECORD_COLUMNS = {"owners": "_owner"}
+# Columns on drive_files and drive_folders that get an index
+INDEXED_COLUMNS = ("_parent", "_owner", "lastModifyingUser", "mimeType", "modifiedTime")
+# Downloads larger than this are spooled to disk rather than memory
+SPOOL_MAX_SIZE = 10 * 1024 * 1024
+BLOB_CHUNK_SIZE = 1024 * 1024
+# Reasons given with a 403 response that mean "slow down" rather than "denied"
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+# Column types for Drive file fields, where they should not be TEXT. The API
+# returns int64 values such as quotaBytesUsed as strings. Booleans are stored
+# as 0 or 1. Timestamps are RFC 3339 strings, which sort correctly as TEXT.
+FIELD_TYPES = {
+    "quotaBytesUsed": int,
+    "size": int,
+    "version": int,
+    "thumbnailVersion": int,
+    "starred": int,
+    "trashed": int,
+    "explicitlyTrashed": int,
+    "hasThumbnail": int,
+    "viewedByMe": int,
+    "modifiedByMe": int,
+    "shared": int,
+    "ownedByMe": int,
+    "viewersCanCopyContent": int,
+    "copyRequiresWriterPermission": int,
+    "writersCanShare": int,
+    "isAppAuthorized": int,
+    "hasAugmentedPermissions": int,
+    "me": int,
+}
+USER_COLUMNS = {
+    "permissionId": str,
+    "kind": str,
+    "displayName": str,
+    "photoLink": str,
+    "me": int,
+    "emailAddress": str,
+}
 
 
 class FilesError(Exception):
@@ -20,8 +93,9 @@ def get_file(client, file_id, fields=None):
     ).json()
 
 
-def paginate_files(client, *, corpora=None, q=None, fields=None):
-    pageToken = None
+def paginate_file_pages(client, *, corpora=None, q=None, fields=None, page_token=None):
+    # Yields (page_token, files) for each page of results, where page_token is
+    # the token that page was fetched with - None for the first page
     files_url = "https://www.googleapis.com/drive/v3/files"
     params = {}
     if corpora is not None:
@@ -30,30 +104,472 @@ def paginate_files(client, *, corpora=None, q=None, fields=None):
         params["fields"] = "nextPageToken, files({})".format(",".join(fields))
     if q:
         params["q"] = q
+    # Time spent on requests and decoding them is recorded to the client's
+    # stats, if it has any
+    stats = getattr(client, "stats", None)
+    phase = stats.phase if stats is not None else lambda name: nullcontext()
     while True:
-        if pageToken is not None:
-            params["pageToken"] = pageToken
+        if page_token is not None:
+            params["pageToken"] = page_token
         else:
             params.pop("pageToken", None)
+        with phase("fetch"):
+            response = client.get(
+                files_url,
+                params=params,
+            )
+        with phase("parse"):
+            data = response.json()
+        if "error" in data:
+            raise FilesError(data)
+        yield page_token, data["files"]
+        page_token = data.get("nextPageToken", None)
+        if page_token is None:
+            break
+
+
+def paginate_files(client, *, corpora=None, q=None, fields=None, state=None):
+    # If a CrawlState is passed, start from its page_token and keep it updated
+    # with the token for the page currently being yielded
+    for page_token, files in paginate_file_pages(
+        client,
+        corpora=corpora,
+        q=q,
+        fields=fields,
+        page_token=state.page_token if state is not None else None,
+    ):
+        if state is not None:
+            state.page_token = page_token
+        yield from files
+
+
+def get_changes_start_page_token(client):
+    data = client.get(
+        "https://www.googleapis.com/drive/v3/changes/startPageToken"
+    ).json()
+    if "error" in data:
+        raise FilesError(data)
+    return data["startPageToken"]
+
+
+def paginate_changes(client, page_token, fields=None):
+    # Yields (changes, page_token) for each page of the changes feed. The
+    # page_token is where to pick up after that page - for the final page it
+    # is the newStartPageToken to use for the next sync
+    changes_url = "https://www.googleapis.com/drive/v3/changes"
+    params = {}
+    if fields is not None:
+        params["fields"] = (
+            "nextPageToken, newStartPageToken, changes(fileId, removed, file({}))".format(
+                ",".join(fields)
+            )
+        )
+    while True:
+        params["pageToken"] = page_token
         data = client.get(
-            files_url,
+            changes_url,
             params=params,
         ).json()
         if "error" in data:
             raise FilesError(data)
-        yield from data["files"]
-        pageToken = data.get("nextPageToken", None)
-        if pageToken is None:
+        page_token = data.get("nextPageToken")
+        if page_token is None:
+            yield data["changes"], data["newStartPageToken"]
             break
+        yield data["changes"], page_token
+
 
+def parents_query(folder_ids):
+    return " or ".join('"{}" in parents'.format(folder_id) for folder_id in folder_ids)
 
-def files_in_folder_recursive(client, folder_id, fields):
-    for file in paginate_files(
-        client, q='"{}" in parents'.format(folder_id), fields=fields
+
+def next_parents_batch(frontier, idle_workers, can_batch=True, page_tokens=None):
+    # Take the next batch of folders to query from the frontier deque, spreading
+    # the frontier evenly across the idle workers. Folders with a page token in
+    # page_tokens were part way through being listed, and are queried alone.
+    page_tokens = page_tokens or {}
+    size = -(-len(frontier) // idle_workers) if can_batch else 1
+    batch = [frontier.popleft()]
+    while (
+        frontier
+        and len(batch) < size
+        and page_tokens.get(batch[0]) is None
+        and page_tokens.get(frontier[0]) is None
+        and len(parents_query(batch + [frontier[0]])) <= MAX_PARENTS_QUERY_LENGTH
     ):
-        yield file
-        if file["mimeType"] == "application/vnd.google-apps.folder":
-            yield from files_in_folder_recursive(client, file["id"], fields)
+        batch.append(frontier.popleft())
+    return batch
+
+
+def group_by_parent(files, folder_ids):
+    # Fan results for a batched query back out so that the children of each
+    # folder are grouped together, in the order of folder_ids
+    files = list(files)
+    if len(folder_ids) > 1:
+        position = {id: i for i, id in enumerate(folder_ids)}
+        files.sort(
+            key=lambda file: min(
+                (position[p] for p in file.get("parents") or [] if p in position),
+                default=0,
+            )
+        )
+    return files
+
+
+def files_in_folder_recursive(client, folder_id, fields, concurrency=1, state=None):
+    # Breadth-first crawl: folders waiting in the frontier are packed together
+    # into '"a" in parents or "b" in parents' queries, up to `concurrency` of
+    # which are fetched at once by worker threads. Each page of results is
+    # yielded as soon as it arrives, apart from queries for several folders
+    # which are read in full so that their results can be grouped by folder.
+    # If a CrawlState is passed, the crawl resumes from its frontier and
+    # records every folder that has not yet been fully yielded, along with
+    # the page reached for folders that are queried on their own.
+    if state is None:
+        state = CrawlState()
+    if state.frontier:
+        frontier = collections.deque(state.frontier)
+    else:
+        frontier = collections.deque(state.add_folders([folder_id]))
+    # Batching needs "parents" in the results to group files by folder
+    can_batch = fields is not None and "parents" in fields
+    # Messages from the workers. Workers wait while it is full, so they can
+    # only get a page or so ahead of whatever is consuming the crawl.
+    results = queue.Queue(maxsize=concurrency)
+    stopped = threading.Event()
+
+    def send(message):
+        # Returns False if the crawl has been abandoned
+        while not stopped.is_set():
+            try:
+                results.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_folders(batch, page_token):
+        # Runs in a worker thread, sending ("page", batch, (page_token, files))
+        # for each page of results and then ("done", batch, None)
+        try:
+            pages = paginate_file_pages(
+                client, q=parents_query(batch), fields=fields, page_token=page_token
+            )
+            if len(batch) > 1:
+                files = (file for _, page in pages for file in page)
+                pages = [(None, group_by_parent(files, batch))]
+            for page in pages:
+                if not send(("page", batch, page)):
+                    return
+            send(("done", batch, None))
+        except Exception as ex:
+            send(("error", batch, ex))
+
+    def submit_batches():
+        while frontier and len(running) < concurrency:
+            batch = next_parents_batch(
+                frontier, concurrency - len(running), can_batch, state.page_tokens
+            )
+            page_token = state.page_tokens.get(batch[0]) if len(batch) == 1 else None
+            running[tuple(batch)] = executor.submit(list_folders, batch, page_token)
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    running = {}
+    try:
+        submit_batches()
+        while running:
+            kind, batch, value = results.get()
+            if kind == "error":
+                raise value
+            if kind == "done":
+                del running[tuple(batch)]
+                state.finish_folders(batch)
+                submit_batches()
+                continue
+            page_token, files = value
+            if len(batch) == 1:
+                state.set_page_token(batch[0], page_token)
+            # Queue up sub-folders before yielding, so workers stay busy
+            frontier.extend(
+                state.add_folders(
+                    file["id"] for file in files if file["mimeType"] == FOLDER_MIME_TYPE
+                )
+            )
+            submit_batches()
+            yield from files
+    finally:
+        stopped.set()
+        for future in running.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class CrawlState:
+    """
+    How far a crawl has got: the pageToken of the page currently being
+    yielded by paginate_files() and, for folder crawls, every folder that has
+    not yet been completely yielded by files_in_folder_recursive() along with
+    the pageToken reached by any of those that were being listed on their own.
+
+    save_files_and_folders() saves this to the database alongside each chunk
+    it commits, so an interrupted crawl can be resumed using load().
+    """
+
+    def __init__(self, params=None, page_token=None, frontier=None, page_tokens=None):
+        # params identifies the crawl, e.g. the q= query or folder ID
+        self.params = params
+        self.page_token = page_token
+        self.frontier = list(frontier or [])
+        self.page_tokens = dict(page_tokens or {})
+        self._unfinished = set(self.frontier)
+        # Folder changes since the last save()
+        self._added = {}
+        self._finished = set()
+        self._page_tokens_changed = {}
+
+    def add_folders(self, folder_ids):
+        # Returns the folders that were not already waiting to be crawled
+        new_folder_ids = []
+        for folder_id in folder_ids:
+            if folder_id not in self._unfinished:
+                self._unfinished.add(folder_id)
+                self._added[folder_id] = None
+                new_folder_ids.append(folder_id)
+        return new_folder_ids
+
+    def set_page_token(self, folder_id, page_token):
+        # The page of this folder's listing that is currently being yielded
+        if self.page_tokens.get(folder_id) != page_token:
+            self.page_tokens[folder_id] = page_token
+            self._page_tokens_changed[folder_id] = page_token
+
+    def finish_folders(self, folder_ids):
+        for folder_id in folder_ids:
+            self._unfinished.discard(folder_id)
+            self.page_tokens.pop(folder_id, None)
+            self._page_tokens_changed.pop(folder_id, None)
+            if folder_id in self._added:
+                del self._added[folder_id]
+            else:
+                self._finished.add(folder_id)
+
+    def save(self, db):
+        # Uses db.execute() so this runs in the caller's transaction
+        ensure_state_tables(db)
+        db.execute(
+            "insert or replace into drive_state (key, value) values (?, ?)",
+            [
+                CHECKPOINT,
+                json.dumps({"params": self.params, "page_token": self.page_token}),
+            ],
+        )
+        if self._added:
+            db.conn.executemany(
+                "insert or ignore into drive_state_frontier (id) values (?)",
+                [(folder_id,) for folder_id in self._added],
+            )
+        if self._page_tokens_changed:
+            db.conn.executemany(
+                "update drive_state_frontier set page_token = ? where id = ?",
+                [
+                    (page_token, folder_id)
+                    for folder_id, page_token in self._page_tokens_changed.items()
+                ],
+            )
+        if self._finished:
+            db.conn.executemany(
+                "delete from drive_state_frontier where id = ?",
+                [(folder_id,) for folder_id in self._finished],
+            )
+        self._added = {}
+        self._finished = set()
+        self._page_tokens_changed = {}
+
+    @classmethod
+    def load(cls, db):
+        # Returns None if there is no checkpoint to resume from
+        checkpoint = get_state(db, CHECKPOINT)
+        if checkpoint is None:
+            return None
+        checkpoint = json.loads(checkpoint)
+        ensure_state_tables(db)
+        rows = db.execute(
+            "select id, page_token from drive_state_frontier order by rowid"
+        ).fetchall()
+        return cls(
+            checkpoint["params"],
+            checkpoint["page_token"],
+            frontier=[id for id, _ in rows],
+            page_tokens={id: page_token for id, page_token in rows if page_token},
+        )
+
+    @staticmethod
+    def clear(db):
+        ensure_state_tables(db)
+        with db.conn:
+            db.execute("delete from drive_state where key = ?", [CHECKPOINT])
+            db.execute("delete from drive_state_frontier")
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request made through a client.
+
+    The rate is increased a little after each successful request and halved
+    whenever the API reports a rate limit error, so it converges on the
+    highest request rate the API will sustain.
+    """
+
+    def __init__(self, rate=20.0, min_rate=0.5, max_rate=500.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        # Allow bursts of up to one second's worth of requests
+        self._tokens = rate
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Take a token, returning how many seconds to wait before using it
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self.rate, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            return max(0, -self._tokens / self.rate)
+
+    def success(self):
+        # Additive increase: roughly one extra request/second every second
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def throttled(self):
+        # Multiplicative decrease, and drop any burst allowance
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+
+def is_rate_limited(response):
+    if response.status_code == 429:
+        return True
+    if response.status_code == 403:
+        try:
+            errors = response.json()["error"]["errors"]
+        except (ValueError, KeyError, TypeError):
+            return False
+        return any(error.get("reason") in RATE_LIMIT_REASONS for error in errors)
+    return False
+
+
+def backoff_delay(response, attempt, max_delay=64):
+    # Honor Retry-After if the API sent one, otherwise exponential backoff
+    # with jitter: 1, 2, 4, 8... seconds plus up to a second of randomness
+    retry_after = response.headers.get("retry-after")
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return min(max_delay, 2**attempt) + random.uniform(0, 1)
+
+
+class Stats:
+    """
+    Counters for a run: requests by endpoint and status code, retries, token
+    refreshes, bytes received, request latencies, rows written per table and
+    time spent in each phase of a crawl.
+
+    An APIClient records its requests to its stats attribute. Pass the same
+    Stats to save_files_and_folders() to count rows. Safe to use from
+    multiple threads.
+    """
+
+    def __init__(self):
+        self.start = monotonic()
+        self.requests = collections.defaultdict(collections.Counter)
+        self.retries = 0
+        self.token_refreshes = 0
+        self.bytes_received = 0
+        self.latencies = []
+        self.rows = collections.Counter()
+        self.phases = collections.Counter()
+        self._lock = threading.Lock()
+
+    def request(self, response, latency):
+        # File IDs are replaced so requests are grouped by endpoint
+        endpoint = "{} {}".format(
+            response.request.method,
+            re.sub(r"/[\w-]{16,}", "/{id}", response.request.url.path),
+        )
+        with self._lock:
+            self.requests[endpoint][str(response.status_code)] += 1
+            self.bytes_received += response.num_bytes_downloaded
+            self.latencies.append(latency)
+
+    def retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def token_refresh(self):
+        with self._lock:
+            self.token_refreshes += 1
+
+    def rows_written(self, table, count):
+        with self._lock:
+            self.rows[table] += count
+
+    @contextmanager
+    def phase(self, name):
+        # Phases are "fetch", "parse", "normalize" and "write". Time from
+        # concurrent threads is added together, so can exceed the elapsed time
+        start = monotonic()
+        try:
+            yield
+        finally:
+            duration = monotonic() - start
+            with self._lock:
+                self.phases[name] += duration
+
+    def as_dict(self):
+        with self._lock:
+            elapsed = monotonic() - self.start
+            latencies = sorted(self.latencies)
+            rows = sum(self.rows.values())
+            return {
+                "elapsed": round(elapsed, 3),
+                "requests": len(latencies),
+                "requests_by_endpoint": {
+                    endpoint: dict(statuses)
+                    for endpoint, statuses in sorted(self.requests.items())
+                },
+                "retries": self.retries,
+                "token_refreshes": self.token_refreshes,
+                "bytes_received": self.bytes_received,
+                "latency": (
+                    {
+                        name: round(percentile(latencies, p), 4)
+                        for name, p in (
+                            ("p50", 50),
+                            ("p90", 90),
+                            ("p99", 99),
+                            ("max", 100),
+                        )
+                    }
+                    if latencies
+                    else None
+                ),
+                "rows_written": dict(self.rows),
+                "rows_per_second": round(rows / elapsed, 1) if elapsed else None,
+                "phases": {
+                    name: round(seconds, 3) for name, seconds in self.phases.items()
+                },
+            }
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of an already sorted list
+    index = max(0, min(len(sorted_values), -(-len(sorted_values) * p // 100)) - 1)
+    return sorted_values[index]
 
 
 class APIClient:
@@ -61,20 +577,68 @@ class APIClient:
         pass
 
     timeout = 30.0
+    rate_limit_retries = 6
 
-    def __init__(self, refresh_token, client_id, client_secret, logger=None):
+    def __init__(
+        self,
+        refresh_token,
+        client_id,
+        client_secret,
+        logger=None,
+        http2=False,
+        max_connections=20,
+        max_keepalive_connections=20,
+        keepalive_expiry=30.0,
+        limiter=None,
+        stats=None,
+        transport=None,
+    ):
         self.refresh_token = refresh_token
         self.access_token = None
         self.client_id = client_id
         self.client_secret = client_secret
         self.log = logger or (lambda s: None)
+        self.limiter = limiter or RateLimiter()
+        self.stats = stats or Stats()
+        self._token_lock = threading.Lock()
+        # A single pooled client is shared by every request made through this
+        # APIClient, so connections are kept alive between pages and downloads
+        # rather than paying for a fresh TCP+TLS handshake each time.
+        # http2=True requires the optional h2 package: pip install 'httpx[http2]'
+        # A custom httpx transport, such as the one used by the benchmarks to
+        # talk to a local mock of the API, replaces the pooled default.
+        self.http = httpx.Client(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=self.timeout,
+            transport=transport,
+        )
+
+    def close(self):
+        self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def get_access_token(self, force_refresh=False):
+        # Lock so that concurrent requests share a single token refresh
+        with self._token_lock:
+            return self._get_access_token(force_refresh)
+
+    def _get_access_token(self, force_refresh):
         if self.access_token and not force_refresh:
             return self.access_token
         url = "https://www.googleapis.com/oauth2/v4/token"
         self.log("POST {}".format(url))
-        data = httpx.post(
+        start = monotonic()
+        response = self.http.post(
             url,
             data={
                 "grant_type": "refresh_token",
@@ -82,8 +646,10 @@ class APIClient:
                 "client_id": self.client_id,
                 "client_secret": self.client_secret,
             },
-            timeout=self.timeout,
-        ).json()
+        )
+        self.stats.request(response, monotonic() - start)
+        self.stats.token_refresh()
+        data = response.json()
         if "error" in data:
             raise self.Error(str(data))
         self.access_token = data["access_token"]
@@ -96,70 +662,491 @@ class APIClient:
         headers=None,
         allow_token_refresh=True,
         transport_retries=2,
+        rate_limit_attempt=0,
     ):
         headers = headers or {}
         headers["Authorization"] = "Bearer {}".format(self.get_access_token())
+        delay = self.limiter.reserve()
+        if delay:
+            sleep(delay)
         self.log("GET: {} {}".format(url, params or "").strip())
+        start = monotonic()
         try:
-            response = httpx.get(
-                url, params=params, headers=headers, timeout=self.timeout
-            )
+            response = self.http.get(url, params=params, headers=headers)
         except httpx.TransportError as ex:
             if transport_retries:
                 sleep(2)
                 self.log("  Got {}, retrying".format(ex.__class__.__name__))
+                self.stats.retry()
                 return self.get(
                     url,
                     params,
                     headers,
                     allow_token_refresh=allow_token_refresh,
                     transport_retries=transport_retries - 1,
+                    rate_limit_attempt=rate_limit_attempt,
                 )
             else:
                 raise
+        self.stats.request(response, monotonic() - start)
 
         if response.status_code == 401 and allow_token_refresh:
             # Try again after refreshing the token
             self.get_access_token(force_refresh=True)
+            self.stats.retry()
             return self.get(url, params, headers, allow_token_refresh=False)
+        if is_rate_limited(response):
+            self.limiter.throttled()
+            if rate_limit_attempt < self.rate_limit_retries:
+                self.stats.retry()
+                delay = backoff_delay(response, rate_limit_attempt)
+                self.log(
+                    "  Got {}, retrying in {:.1f}s, rate now {:.1f} requests/second".format(
+                        response.status_code, delay, self.limiter.rate
+                    )
+                )
+                sleep(delay)
+                return self.get(
+                    url,
+                    params,
+                    headers,
+                    allow_token_refresh=allow_token_refresh,
+                    transport_retries=transport_retries,
+                    rate_limit_attempt=rate_limit_attempt + 1,
+                )
+            return response
+        self.limiter.success()
         return response
 
     def post(self, url, data=None, headers=None, allow_token_refresh=True):
         headers = headers or {}
         headers["Authorization"] = "Bearer {}".format(self.get_access_token())
         self.log("POST: {}".format(url))
-        response = httpx.post(url, data=data, headers=headers, timeout=self.timeout)
+        start = monotonic()
+        response = self.http.post(url, data=data, headers=headers)
+        self.stats.request(response, monotonic() - start)
         if response.status_code == 403 and allow_token_refresh:
             self.get_access_token(force_refresh=True)
+            self.stats.retry()
             return self.post(url, data, headers, allow_token_refresh=False)
         return response
 
     @contextmanager
     def stream(self, method, url, params=None):
-        with httpx.stream(
-            method,
-            url,
+        for rate_limit_attempt in itertools.count():
+            delay = self.limiter.reserve()
+            if delay:
+                sleep(delay)
+            start = monotonic()
+            with self.http.stream(
+                method,
+                url,
+                params=params,
+                headers={"Authorization": "Bearer {}".format(self.get_access_token())},
+            ) as stream:
+                # Latency is the time until the response headers arrived
+                latency = monotonic() - start
+                if (
+                    stream.status_code in (403, 429)
+                    and rate_limit_attempt < self.rate_limit_retries
+                ):
+                    # Error bodies are small, read them to check the reason
+                    stream.read()
+                    if is_rate_limited(stream):
+                        self.stats.request(stream, latency)
+                        self.limiter.throttled()
+                        self.stats.retry()
+                        delay = backoff_delay(stream, rate_limit_attempt)
+                        self.log(
+                            "  Got {}, retrying in {:.1f}s".format(
+                                stream.status_code, delay
+                            )
+                        )
+                        sleep(delay)
+                        continue
+                self.limiter.success()
+                try:
+                    yield stream
+                finally:
+                    self.stats.request(stream, latency)
+                return
+
+
+class AsyncAPIClient:
+    "asyncio equivalent of APIClient, using a pooled httpx.AsyncClient"
+
+    Error = APIClient.Error
+
+    timeout = 30.0
+    rate_limit_retries = 6
+
+    def __init__(
+        self,
+        refresh_token,
+        client_id,
+        client_secret,
+        logger=None,
+        http2=False,
+        max_connections=100,
+        max_keepalive_connections=100,
+        keepalive_expiry=30.0,
+        limiter=None,
+    ):
+        self.refresh_token = refresh_token
+        self.access_token = None
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.log = logger or (lambda s: None)
+        self.limiter = limiter or RateLimiter()
+        # Created on first use, so it belongs to the running event loop
+        self._token_lock = None
+        self.http = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=self.timeout,
+        )
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def get_access_token(self, force_refresh=False):
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        # Lock so that concurrent requests share a single token refresh
+        async with self._token_lock:
+            if self.access_token and not force_refresh:
+                return self.access_token
+            url = "https://www.googleapis.com/oauth2/v4/token"
+            self.log("POST {}".format(url))
+            response = await self.http.post(
+                url,
+                data={
+                    "grant_type": "refresh_token",
+                    "refresh_token": self.refresh_token,
+                    "client_id": self.client_id,
+                    "client_secret": self.client_secret,
+                },
+            )
+            data = response.json()
+            if "error" in data:
+                raise self.Error(str(data))
+            self.access_token = data["access_token"]
+            return self.access_token
+
+    async def get(
+        self,
+        url,
+        params=None,
+        headers=None,
+        allow_token_refresh=True,
+        transport_retries=2,
+        rate_limit_attempt=0,
+    ):
+        headers = headers or {}
+        headers["Authorization"] = "Bearer {}".format(await self.get_access_token())
+        delay = self.limiter.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        self.log("GET: {} {}".format(url, params or "").strip())
+        try:
+            response = await self.http.get(url, params=params, headers=headers)
+        except httpx.TransportError as ex:
+            if transport_retries:
+                await asyncio.sleep(2)
+                self.log("  Got {}, retrying".format(ex.__class__.__name__))
+                return await self.get(
+                    url,
+                    params,
+                    headers,
+                    allow_token_refresh=allow_token_refresh,
+                    transport_retries=transport_retries - 1,
+                    rate_limit_attempt=rate_limit_attempt,
+                )
+            else:
+                raise
+
+        if response.status_code == 401 and allow_token_refresh:
+            # Try again after refreshing the token
+            await self.get_access_token(force_refresh=True)
+            return await self.get(url, params, headers, allow_token_refresh=False)
+        if is_rate_limited(response):
+            self.limiter.throttled()
+            if rate_limit_attempt < self.rate_limit_retries:
+                delay = backoff_delay(response, rate_limit_attempt)
+                self.log(
+                    "  Got {}, retrying in {:.1f}s, rate now {:.1f} requests/second".format(
+                        response.status_code, delay, self.limiter.rate
+                    )
+                )
+                await asyncio.sleep(delay)
+                return await self.get(
+                    url,
+                    params,
+                    headers,
+                    allow_token_refresh=allow_token_refresh,
+                    transport_retries=transport_retries,
+                    rate_limit_attempt=rate_limit_attempt + 1,
+                )
+            return response
+        self.limiter.success()
+        return response
+
+    async def post(self, url, data=None, headers=None, allow_token_refresh=True):
+        headers = headers or {}
+        headers["Authorization"] = "Bearer {}".format(await self.get_access_token())
+        self.log("POST: {}".format(url))
+        response = await self.http.post(url, data=data, headers=headers)
+        if response.status_code == 403 and allow_token_refresh:
+            await self.get_access_token(force_refresh=True)
+            return await self.post(url, data, headers, allow_token_refresh=False)
+        return response
+
+    @asynccontextmanager
+    async def stream(self, method, url, params=None):
+        for rate_limit_attempt in itertools.count():
+            delay = self.limiter.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            async with self.http.stream(
+                method,
+                url,
+                params=params,
+                headers={
+                    "Authorization": "Bearer {}".format(await self.get_access_token())
+                },
+            ) as stream:
+                if (
+                    stream.status_code in (403, 429)
+                    and rate_limit_attempt < self.rate_limit_retries
+                ):
+                    # Error bodies are small, read them to check the reason
+                    await stream.aread()
+                    if is_rate_limited(stream):
+                        self.limiter.throttled()
+                        delay = backoff_delay(stream, rate_limit_attempt)
+                        self.log(
+                            "  Got {}, retrying in {:.1f}s".format(
+                                stream.status_code, delay
+                            )
+                        )
+                        await asyncio.sleep(delay)
+                        continue
+                self.limiter.success()
+                yield stream
+                return
+
+
+async def get_file_async(client, file_id, fields=None):
+    file_url = "https://www.googleapis.com/drive/v3/files/{}".format(file_id)
+    params = {}
+    if fields is not None:
+        params["fields"] = ",".join(fields)
+    response = await client.get(
+        file_url,
+        params=params,
+    )
+    return response.json()
+
+
+async def paginate_file_pages_async(
+    client, *, corpora=None, q=None, fields=None, page_token=None
+):
+    # Yields (page_token, files) for each page, as paginate_file_pages() does
+    files_url = "https://www.googleapis.com/drive/v3/files"
+    params = {}
+    if corpora is not None:
+        params["corpora"] = corpora
+    if fields is not None:
+        params["fields"] = "nextPageToken, files({})".format(",".join(fields))
+    if q:
+        params["q"] = q
+    while True:
+        if page_token is not None:
+            params["pageToken"] = page_token
+        else:
+            params.pop("pageToken", None)
+        response = await client.get(
+            files_url,
             params=params,
-            headers={"Authorization": "Bearer {}".format(self.get_access_token())},
-        ) as stream:
-            yield stream
+        )
+        data = response.json()
+        if "error" in data:
+            raise FilesError(data)
+        yield page_token, data["files"]
+        page_token = data.get("nextPageToken", None)
+        if page_token is None:
+            break
+
+
+async def paginate_files_async(client, *, corpora=None, q=None, fields=None):
+    async for _, files in paginate_file_pages_async(
+        client, corpora=corpora, q=q, fields=fields
+    ):
+        for file in files:
+            yield file
 
 
-def save_files_and_folders(db, all):
-    # Ensure tables with foreign keys exist
+async def files_in_folder_recursive_async(client, folder_id, fields, concurrency=10):
+    # Same breadth-first, batched crawl as files_in_folder_recursive(), with up
+    # to `concurrency` queries in flight as tasks on the running event loop
+    can_batch = fields is not None and "parents" in fields
+    # Messages from the tasks, which wait while it is full
+    results = asyncio.Queue(maxsize=concurrency)
+
+    async def list_folders(folder_ids):
+        # Puts ("page", files) for each page of results, then ("done", None)
+        try:
+            pages = paginate_file_pages_async(
+                client, q=parents_query(folder_ids), fields=fields
+            )
+            if len(folder_ids) > 1:
+                files = [file async for _, page in pages for file in page]
+                await results.put(("page", group_by_parent(files, folder_ids)))
+            else:
+                async for _, files in pages:
+                    await results.put(("page", files))
+            await results.put(("done", None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            await results.put(("error", ex))
+
+    def submit_batches():
+        nonlocal running
+        while frontier and running < concurrency:
+            batch = next_parents_batch(frontier, concurrency - running, can_batch)
+            task = asyncio.ensure_future(list_folders(batch))
+            task.add_done_callback(tasks.discard)
+            tasks.add(task)
+            running += 1
+
+    frontier = collections.deque([folder_id])
+    seen = {folder_id}
+    tasks = set()
+    running = 0
+    try:
+        submit_batches()
+        while running:
+            kind, value = await results.get()
+            if kind == "error":
+                raise value
+            if kind == "done":
+                running -= 1
+                submit_batches()
+                continue
+            for file in value:
+                if file["mimeType"] == FOLDER_MIME_TYPE and file["id"] not in seen:
+                    seen.add(file["id"])
+                    frontier.append(file["id"])
+            submit_batches()
+            for file in value:
+                yield file
+    finally:
+        for task in list(tasks):
+            task.cancel()
+
+
+@contextmanager
+def bulk_load(db, cache_size_kb=100_000):
+    """
+    Faster but less crash-safe SQLite settings for large imports: a WAL journal,
+    synchronous=NORMAL so transactions don't wait on fsync, and a larger page
+    cache. The previous settings are restored afterwards.
+    """
+    previous = {
+        pragma: db.execute("pragma {}".format(pragma)).fetchone()[0]
+        for pragma in ("journal_mode", "synchronous", "cache_size", "temp_store")
+    }
+    db.execute("pragma journal_mode = wal")
+    db.execute("pragma synchronous = normal")
+    db.execute("pragma cache_size = {}".format(-int(cache_size_kb)))
+    db.execute("pragma temp_store = memory")
+    try:
+        yield db
+    finally:
+        for pragma, value in previous.items():
+            db.execute("pragma {} = {}".format(pragma, value))
+
+
+def ensure_indexes(db):
+    # Create any missing column indexes, and an FTS5 index on name that is kept
+    # up-to-date using triggers. Creating these after a bulk load is faster
+    # than maintaining them during it.
+    for table in ("drive_folders", "drive_files"):
+        if not db[table].exists():
+            continue
+        columns = db[table].columns_dict
+        with db.conn:
+            for column in INDEXED_COLUMNS:
+                if column in columns:
+                    db[table].create_index([column], if_not_exists=True)
+            if "name" in columns and not db[table].detect_fts():
+                db[table].enable_fts(["name"], fts_version="FTS5", create_triggers=True)
+
+
+def split_fields(spec):
+    # Split "id,owners(displayName,permissionId)" on the top-level commas only
+    fields, depth, current = [], 0, ""
+    for character in spec + ",":
+        if character == "," and depth == 0:
+            if current.strip():
+                fields.append(current.strip())
+            current = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(character, 0)
+        current += character
+    return fields
+
+
+def field_name(field):
+    # The top-level name of a field selector, e.g. "owners(displayName)" or
+    # "capabilities/canEdit" are saved to the owners and capabilities columns
+    return re.split(r"[(/]", field, maxsplit=1)[0].strip()
+
+
+def file_columns(fields=None, path=False):
+    # Typed columns for the drive_files and drive_folders tables. Folders also
+    # have a _path column, maintained by update_folder_paths()
+    columns = {"id": str, "_parent": str}
+    if path:
+        columns["_path"] = str
+    columns.update({"_owner": str, "lastModifyingUser": str})
+    for name in map(field_name, fields or []):
+        if name not in columns and name != "owners":
+            columns[name] = FIELD_TYPES.get(name, str)
+    return columns
+
+
+def save_files_and_folders(
+    db,
+    all,
+    checkpoint=None,
+    batch_size=100,
+    fields=None,
+    create_indexes=True,
+    stats=None,
+):
+    # Ensure tables with foreign keys exist. If we know the fields that were
+    # requested the tables are created with all of their columns up front.
     with db.conn:
         if not db["drive_users"].exists():
-            db["drive_users"].create({"permissionId": str}, pk="permissionId")
+            db["drive_users"].create(
+                USER_COLUMNS if fields else {"permissionId": str}, pk="permissionId"
+            )
         for table in ("drive_folders", "drive_files"):
             if not db[table].exists():
                 db[table].create(
-                    {
-                        "id": str,
-                        "_parent": str,
-                        "_owner": str,
-                        "lastModifyingUser": str,
-                    },
-                    pk="id",
+                    file_columns(fields, path=table == "drive_folders"), pk="id"
                 )
                 # Gotta add foreign key after table is created, to avoid
                 # AlterError: No such column: drive_folders.id
@@ -170,80 +1157,647 @@ def save_files_and_folders(db, all):
                         (table, "lastModifyingUser", "drive_users", "permissionId"),
                     )
                 )
+        # Databases created before the closure table and _path existed have
+        # their hierarchy filled in from the folders that are already saved
+        backfill = False
+        if "_path" not in db["drive_folders"].columns_dict:
+            db["drive_folders"].add_column("_path", str)
+            backfill = True
+        if ensure_folder_closure_table(db) or backfill:
+            backfill_folder_closure(db)
+    if create_indexes:
+        ensure_indexes(db)
+    # Introspect the tables once - chunks are inserted without schema checks
+    # unless they contain a key that is not already a column
+    known_columns = {
+        table: set(db[table].columns_dict)
+        for table in ("drive_users", "drive_folders", "drive_files")
+    }
 
-    # Commit every 100 records
+    # Time spent preparing rows and writing them is recorded to stats
+    phase = stats.phase if stats is not None else lambda name: nullcontext()
+    # Commit every batch_size records
     users_seen = set()
-    for chunk in chunks(all, 100):
-        # Add `_parent` columns
-        files = []
-        folders = []
-        for file in chunk:
-            file["_parent"] = file["parents"][0] if file.get("parents") else None
-            if file.get("mimeType") == "application/vnd.google-apps.folder":
-                folders.append(file)
-            else:
-                files.append(file)
-        # Convert "lastModifyingUser" JSON into a foreign key reference to drive_users
-        drive_folders_owners_to_insert = []
-        drive_files_owners_to_insert = []
-        for to_insert_list, sequence in (
-            (drive_folders_owners_to_insert, folders),
-            (drive_files_owners_to_insert, files),
-        ):
-            for file in sequence:
-                last_modifying_user = file.get("lastModifyingUser")
-                # This can be {'displayName': '', 'kind': 'drive#user', 'me': False}
-                if last_modifying_user and last_modifying_user.get("permissionId"):
-                    user_id = last_modifying_user["permissionId"]
-                    if user_id not in users_seen:
-                        db["drive_users"].insert(
-                            last_modifying_user,
-                            replace=True,
-                            pk="permissionId",
-                            alter=True,
-                        )
-                        users_seen.add(user_id)
-                    file["lastModifyingUser"] = user_id
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    for chunk in chunks(all, batch_size):
+        with phase("normalize"):
+            # Add `_parent` columns
+            files = []
+            folders = []
+            for file in chunk:
+                file["_parent"] = file["parents"][0] if file.get("parents") else None
+                if file.get("mimeType") == FOLDER_MIME_TYPE:
+                    folders.append(file)
                 else:
-                    file["lastModifyingUser"] = None
-                owners = file.pop("owners", None)
-                file["_owner"] = None
-                if owners and owners[0].get("permissionId"):
-                    owner_user_id = owners[0]["permissionId"]
-                    if owner_user_id not in users_seen:
-                        db["drive_users"].insert(
-                            owners[0],
-                            replace=True,
-                            pk="permissionId",
-                            alter=True,
-                        )
-                        users_seen.add(owner_user_id)
-                    file["_owner"] = owner_user_id
+                    files.append(file)
+        with phase("write"):
+            # Skip rows that have not changed since they were last saved
+            folders = new_or_changed(
+                db, "drive_folders", folders, counts, known_columns["drive_folders"]
+            )
+            files = new_or_changed(
+                db, "drive_files", files, counts, known_columns["drive_files"]
+            )
+        with phase("normalize"):
+            # Convert "lastModifyingUser" JSON into a foreign key reference to drive_users
+            # New users are collected and written with a single insert_all() per chunk
+            users_to_insert = {}
+            drive_folders_owners_to_insert = []
+            drive_files_owners_to_insert = []
+            for to_insert_list, sequence in (
+                (drive_folders_owners_to_insert, folders),
+                (drive_files_owners_to_insert, files),
+            ):
+                for file in sequence:
+                    last_modifying_user = file.get("lastModifyingUser")
+                    # This can be {'displayName': '', 'kind': 'drive#user', 'me': False}
+                    if last_modifying_user and last_modifying_user.get("permissionId"):
+                        user_id = last_modifying_user["permissionId"]
+                        if user_id not in users_seen:
+                            users_to_insert[user_id] = last_modifying_user
+                            users_seen.add(user_id)
+                        file["lastModifyingUser"] = user_id
+                    else:
+                        file["lastModifyingUser"] = None
+                    owners = file.pop("owners", None)
+                    file["_owner"] = None
+                    if owners and owners[0].get("permissionId"):
+                        owner_user_id = owners[0]["permissionId"]
+                        if owner_user_id not in users_seen:
+                            users_to_insert[owner_user_id] = owners[0]
+                            users_seen.add(owner_user_id)
+                        file["_owner"] = owner_user_id
+
+        with phase("write"):
+            with db.conn:
+                if users_to_insert:
+                    users = list(users_to_insert.values())
+                    add_missing_columns(db, "drive_users", users, known_columns)
+                    db["drive_users"].insert_all(
+                        users,
+                        pk="permissionId",
+                        replace=True,
+                    )
+                add_missing_columns(db, "drive_folders", folders, known_columns)
+                db["drive_folders"].insert_all(
+                    folders,
+                    pk="id",
+                    replace=True,
+                )
+                if folders:
+                    update_folder_closure(db, folders)
+                    update_folder_paths(db, [folder["id"] for folder in folders])
+                add_missing_columns(db, "drive_files", files, known_columns)
+                db["drive_files"].insert_all(
+                    files,
+                    pk="id",
+                    replace=True,
+                )
+                if drive_folders_owners_to_insert:
+                    db["drive_folders_owners"].insert_all(
+                        drive_folders_owners_to_insert, replace=True
+                    )
+                if drive_files_owners_to_insert:
+                    db["drive_files_owners"].insert_all(
+                        drive_files_owners_to_insert, replace=True
+                    )
+                if checkpoint is not None:
+                    checkpoint.save(db)
+        if stats is not None:
+            stats.rows_written("drive_users", len(users_to_insert))
+            stats.rows_written("drive_folders", len(folders))
+            stats.rows_written("drive_files", len(files))
+    return counts
 
+
+def ensure_folder_closure_table(db):
+    # One row for every folder and each of the folders it is inside, plus a
+    # row for each folder with itself at depth 0. Returns True if the table
+    # had to be created.
+    if db["drive_folder_closure"].exists():
+        return False
+    db["drive_folder_closure"].create(
+        {"ancestor": str, "descendant": str, "depth": int},
+        pk=("ancestor", "descendant"),
+    )
+    db["drive_folder_closure"].create_index(["descendant"])
+    return True
+
+
+def backfill_folder_closure(db):
+    # Build the closure table and every _path from the _parent column of all
+    # saved folders, as update_folder_closure() would have done one at a time
+    if not db.execute("select 1 from drive_folders limit 1").fetchone():
+        return
+    db.execute("""
+        insert or ignore into drive_folder_closure (ancestor, descendant, depth)
+        with recursive closure (ancestor, descendant, depth) as (
+            select id, id, 0 from drive_folders
+            union all
+            select _parent, _parent, 0 from drive_folders where _parent is not null
+            union all
+            select parents._parent, closure.descendant, closure.depth + 1
+            from closure join drive_folders parents on parents.id = closure.ancestor
+            where parents._parent is not null
+            and closure.depth < (select count(*) from drive_folders)
+        )
+        select ancestor, descendant, depth from closure
+        """)
+    update_folder_paths(db)
+
+
+def update_folder_closure(db, folders):
+    # Folders can arrive before their parents, so each parent gets a depth 0
+    # row straight away. When the parent is saved later it links its own
+    # ancestors to everything below it.
+    for folder in folders:
+        params = {"id": folder["id"], "parent": folder.get("_parent")}
+        rows = db.execute(
+            "select ancestor, depth from drive_folder_closure"
+            " where descendant = :id and depth <= 1",
+            params,
+        ).fetchall()
+        if (folder["id"], 0) in rows and (
+            [ancestor for ancestor, depth in rows if depth == 1]
+            == ([params["parent"]] if params["parent"] else [])
+        ):
+            # Already in the right place
+            continue
+        # Detach this folder and everything below it from its old ancestors
+        db.execute(
+            """
+            delete from drive_folder_closure
+            where descendant in (
+                select descendant from drive_folder_closure where ancestor = :id
+            )
+            and ancestor not in (
+                select descendant from drive_folder_closure where ancestor = :id
+            )
+            """,
+            params,
+        )
+        db.execute(
+            "insert or ignore into drive_folder_closure values (:id, :id, 0)", params
+        )
+        if params["parent"] is None:
+            continue
+        db.execute(
+            "insert or ignore into drive_folder_closure values (:parent, :parent, 0)",
+            params,
+        )
+        db.execute(
+            """
+            insert or replace into drive_folder_closure (ancestor, descendant, depth)
+            select above.ancestor, below.descendant, above.depth + below.depth + 1
+            from drive_folder_closure above, drive_folder_closure below
+            where above.descendant = :parent and below.ancestor = :id
+            """,
+            params,
+        )
+
+
+def update_folder_paths(db, folder_ids=None):
+    # Set _path to the slash-separated names of the folders from the topmost
+    # known ancestor down, for these folders and every folder inside them, or
+    # for every folder if folder_ids is None
+    sql = """
+        update drive_folders set _path = (
+            select group_concat(name, '/') from (
+                select ancestors.name
+                from drive_folder_closure
+                join drive_folders ancestors
+                    on ancestors.id = drive_folder_closure.ancestor
+                where drive_folder_closure.descendant = drive_folders.id
+                order by drive_folder_closure.depth desc
+            )
+        )
+    """
+    if folder_ids is None:
+        db.execute(sql)
+        return
+    db.execute(
+        sql + """
+        where id in (
+            select descendant from drive_folder_closure
+            where ancestor in (select value from json_each(?))
+        )
+        """,
+        [json.dumps(folder_ids)],
+    )
+
+
+def add_missing_columns(db, table, records, known_columns):
+    # Fallback for keys that are not yet columns, using FIELD_TYPES where known
+    missing = {}
+    for record in records:
+        for key in record:
+            if key not in known_columns[table]:
+                missing[key] = FIELD_TYPES.get(key)
+    if not missing:
+        return
+    suggested = suggest_column_types(records)
+    for key, column_type in missing.items():
+        db[table].add_column(key, column_type or suggested[key])
+    known_columns[table].update(missing)
+
+
+def new_or_changed(db, table, records, counts, columns):
+    # Filter records down to those that are not yet in the table or that have
+    # changed since they were saved, updating counts. A record has changed if
+    # its version or modifiedTime differ from the stored row, or if it has
+    # fields that are not stored yet - for example ones newly added with
+    # --fields - which are either not columns or are NULL in the stored row
+    if not records:
+        return records
+    ids = json.dumps([record["id"] for record in records])
+    if not {"version", "modifiedTime"} <= columns:
+        # No way to tell what changed, so every record is saved again
+        existing = {
+            row[0]
+            for row in db.execute(
+                "select id from [{}] where id in (select value from json_each(?))".format(
+                    table
+                ),
+                [ids],
+            )
+        }
+        for record in records:
+            counts["updated" if str(record["id"]) in existing else "inserted"] += 1
+        return records
+    compare = sorted(
+        {
+            RECORD_COLUMNS.get(key, key)
+            for record in records
+            for key in record
+            if RECORD_COLUMNS.get(key, key) in columns
+        }
+        - {"id", "version", "modifiedTime"}
+    )
+    existing = {
+        row[0]: row[1:]
+        for row in db.execute(
+            "select {} from [{}] where id in (select value from json_each(?))".format(
+                ", ".join(
+                    "[{}]".format(column)
+                    for column in ["id", "version", "modifiedTime"] + compare
+                ),
+                table,
+            ),
+            [ids],
+        )
+    }
+    to_save = []
+    for record in records:
+        stored = existing.get(str(record["id"]))
+        if stored is None:
+            counts["inserted"] += 1
+        elif (
+            (record.get("version"), record.get("modifiedTime")) != (None, None)
+            and as_strings(stored[:2])
+            == as_strings((record.get("version"), record.get("modifiedTime")))
+            and not unstored_fields(
+                record,
+                dict(zip(["version", "modifiedTime"] + compare, stored)),
+                columns,
+            )
+        ):
+            counts["unchanged"] += 1
+            continue
+        else:
+            counts["updated"] += 1
+        to_save.append(record)
+    return to_save
+
+
+def unstored_fields(record, stored, columns):
+    # Keys of record that have a value but no column, or a NULL column, in the
+    # stored row. Users without a permissionId are saved as NULL.
+    unstored = []
+    for key, value in record.items():
+        column = RECORD_COLUMNS.get(key, key)
+        if key in ("owners", "lastModifyingUser"):
+            user = value[0] if key == "owners" and value else value
+            value = user.get("permissionId") if isinstance(user, dict) else None
+        if value is None or column == "id":
+            continue
+        if column not in columns or stored.get(column) is None:
+            unstored.append(key)
+    return unstored
+
+
+def save_changes(db, client, page_token, fields=None, stats=None):
+    # Apply the changes feed since page_token to the database, recording the
+    # page token reached after each page. Returns (num_changed, num_removed)
+    num_changed = 0
+    num_removed = 0
+    for changes, page_token in paginate_changes(client, page_token, fields):
+        files = []
+        removed = []
+        for change in changes:
+            if change.get("removed"):
+                removed.append(change["fileId"])
+            elif change.get("file"):
+                files.append(change["file"])
+        save_files_and_folders(db, files, fields=fields, stats=stats)
         with db.conn:
-            db["drive_folders"].insert_all(
-                folders,
-                pk="id",
-                replace=True,
-                alter=True,
-            )
-            db["drive_files"].insert_all(
-                files,
-                pk="id",
-                replace=True,
-                alter=True,
-            )
-            if drive_folders_owners_to_insert:
-                db["drive_folders_owners"].insert_all(
-                    drive_folders_owners_to_insert, replace=True
+            if removed:
+                for table in ("drive_folders", "drive_files"):
+                    db[table].delete_where(
+                        "id in ({})".format(", ".join("?" for _ in removed)),
+                        removed,
+                    )
+                db["drive_folder_closure"].delete_where(
+                    "ancestor in (select value from json_each(:ids))"
+                    " or descendant in (select value from json_each(:ids))",
+                    {"ids": json.dumps(removed)},
                 )
-            if drive_files_owners_to_insert:
-                db["drive_files_owners"].insert_all(
-                    drive_files_owners_to_insert, replace=True
+            set_state(db, CHANGES_PAGE_TOKEN, page_token)
+        num_changed += len(files)
+        num_removed += len(removed)
+    return num_changed, num_removed
+
+
+def ensure_file_contents_table(db):
+    if not db["drive_file_contents"].exists():
+        db["drive_file_contents"].create(
+            {"id": str, "md5Checksum": str, "size": int, "content": bytes}, pk="id"
+        )
+        db["drive_file_contents"].create_index(["md5Checksum"])
+
+
+def copy_file_contents(db, from_id, to_id):
+    # Files with identical content can share a stored copy of it
+    db.execute(
+        "insert or replace into drive_file_contents (id, md5Checksum, size, content)"
+        " select ?, md5Checksum, size, content from drive_file_contents where id = ?",
+        [to_id, from_id],
+    )
+
+
+def spool(chunks):
+    # Copy chunks to a temporary file, only using memory for small files.
+    # Returns (fp, size, md5 hex digest) with fp positioned at the start.
+    fp = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    md5 = hashlib.md5()
+    for chunk in chunks:
+        fp.write(chunk)
+        md5.update(chunk)
+    size = fp.tell()
+    fp.seek(0)
+    return fp, size, md5.hexdigest()
+
+
+def save_file_contents(db, file_id, chunks, size=None, md5_checksum=None):
+    """
+    Write the content of a file to the drive_file_contents table.
+
+    When size and md5_checksum are known the row is created with a zeroblob()
+    of that size and chunks are written into it using incremental blob I/O, so
+    the content is never held in memory. Otherwise chunks are spooled to a
+    temporary file first to find out the size and checksum.
+    """
+    ensure_file_contents_table(db)
+    can_stream = hasattr(db.conn, "blobopen")  # Python 3.11+
+    fp = None
+    if size is None or md5_checksum is None or not can_stream:
+        fp, spooled_size, digest = spool(chunks)
+        if size is not None and spooled_size != size:
+            raise FilesError(
+                "{}: expected {} bytes, got {}".format(file_id, size, spooled_size)
+            )
+        if md5_checksum is not None and digest != md5_checksum:
+            raise FilesError("{}: md5Checksum does not match".format(file_id))
+        size, md5_checksum = spooled_size, digest
+        chunks = iter(lambda: fp.read(BLOB_CHUNK_SIZE), b"")
+    try:
+        with db.conn:
+            if not can_stream:
+                db.execute(
+                    "insert or replace into drive_file_contents"
+                    " (id, md5Checksum, size, content) values (?, ?, ?, ?)",
+                    [file_id, md5_checksum, size, b"".join(chunks)],
                 )
+                return md5_checksum
+            cursor = db.execute(
+                "insert or replace into drive_file_contents"
+                " (id, md5Checksum, size, content) values (?, ?, ?, zeroblob(?))",
+                [file_id, md5_checksum, size, size],
+            )
+            md5 = hashlib.md5()
+            written = 0
+            with db.conn.blobopen(
+                "drive_file_contents", "content", cursor.lastrowid
+            ) as blob:
+                for chunk in chunks:
+                    if written + len(chunk) > size:
+                        raise FilesError(
+                            "{}: more than the expected {} bytes".format(file_id, size)
+                        )
+                    blob.write(chunk)
+                    md5.update(chunk)
+                    written += len(chunk)
+            # Raising here rolls back the transaction, discarding the row
+            if written != size:
+                raise FilesError(
+                    "{}: expected {} bytes, got {}".format(file_id, size, written)
+                )
+            if md5.hexdigest() != md5_checksum:
+                raise FilesError("{}: md5Checksum does not match".format(file_id))
+    finally:
+        if fp is not None:
+            fp.close()
+    return md5_checksum
+
+
+def ensure_file_text_table(db):
+    if not db["drive_file_text"].exists():
+        db["drive_file_text"].create(
+            {"id": str, "modifiedTime": str, "text": str}, pk="id"
+        )
+        db["drive_file_text"].enable_fts(
+            ["text"], fts_version="FTS5", create_triggers=True
+        )
+
+
+def files_to_index(db):
+    # Exportable files that have not been indexed since they were last modified.
+    # Rows for files that are no longer in drive_files are removed.
+    ensure_file_text_table(db)
+    if not db["drive_files"].exists():
+        return []
+    missing = [
+        column
+        for column in ("mimeType", "modifiedTime")
+        if column not in db["drive_files"].columns_dict
+    ]
+    if missing:
+        raise click.ClickException(
+            "drive_files has no {} column, which is needed to find files to "
+            "index - run the files command with --fields +{}".format(
+                " or ".join(missing), ",+".join(missing)
+            )
+        )
+    with db.conn:
+        db.execute(
+            "delete from drive_file_text where id not in (select id from drive_files)"
+        )
+    return [
+        dict(row)
+        for row in db.query(
+            """
+            select drive_files.id, drive_files.mimeType, drive_files.modifiedTime
+            from drive_files
+            left join drive_file_text on drive_file_text.id = drive_files.id
+            where drive_files.mimeType in ({})
+            and (
+                drive_file_text.id is null
+                or drive_file_text.modifiedTime is not drive_files.modifiedTime
+            )
+            """.format(", ".join("?" for _ in TEXT_EXPORT_FORMATS)),
+            list(TEXT_EXPORT_FORMATS),
+        )
+    ]
+
+
+def export_text(client, file):
+    response = client.get(
+        "https://www.googleapis.com/drive/v3/files/{}/export".format(file["id"]),
+        params={"mimeType": TEXT_EXPORT_FORMATS[file["mimeType"]]},
+    )
+    if response.status_code != 200:
+        raise FilesError("{}: {}".format(response.status_code, response.text))
+    # Exported documents start with a byte order mark
+    return response.content.decode("utf-8-sig")
+
+
+def save_file_text(db, file, text):
+    with db.conn:
+        db["drive_file_text"].insert(
+            {"id": file["id"], "modifiedTime": file["modifiedTime"], "text": text},
+            replace=True,
+        )
+
+
+def ensure_state_tables(db):
+    if not db["drive_state"].exists():
+        db["drive_state"].create({"key": str, "value": str}, pk="key")
+    if not db["drive_state_frontier"].exists():
+        db["drive_state_frontier"].create({"id": str, "page_token": str}, pk="id")
+    elif "page_token" not in db["drive_state_frontier"].columns_dict:
+        db["drive_state_frontier"].add_column("page_token", str)
+
+
+def as_strings(values):
+    # version is returned by the API as a string but stored as an integer
+    return tuple(None if value is None else str(value) for value in values)
+
+
+def get_state(db, key):
+    if not db["drive_state"].exists():
+        return None
+    rows = list(db["drive_state"].rows_where("key = ?", [key]))
+    return rows[0]["value"] if rows else None
+
+
+def set_state(db, key, value):
+    ensure_state_tables(db)
+    db["drive_state"].insert({"key": key, "value": value}, replace=True)
 
 
 def chunks(sequence, size):
     iterator = iter(sequence)
     for item in iterator:
         yield itertools.chain([item], itertools.islice(iterator, size - 1))
+
+
+def iter_json_array(fp, chunk_size=64 * 1024):
+    # Yield the items of a top-level JSON array one at a time, reading fp in
+    # chunks rather than loading the whole document into memory
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        # Read another chunk, discarding what has already been parsed
+        nonlocal buffer, pos, eof
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    def expect(characters):
+        nonlocal pos
+        skip_whitespace()
+        if pos >= len(buffer) or buffer[pos] not in characters:
+            raise json.JSONDecodeError(
+                "Expecting {}".format(" or ".join(repr(c) for c in characters)),
+                buffer,
+                pos,
+            )
+        pos += 1
+        return buffer[pos - 1]
+
+    expect("[")
+    skip_whitespace()
+    if buffer[pos : pos + 1] == "]":
+        return
+    while True:
+        skip_whitespace()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            # A number cut off at the end of a chunk can still decode, with
+            # "2." read as 2, so only accept a value once the "," or "]"
+            # after it has been read
+            following = end
+            while following < len(buffer) and buffer[following].isspace():
+                following += 1
+            if not eof and buffer[following : following + 1] not in (",", "]"):
+                fill()
+                continue
+            break
+        pos = end
+        yield item
+        if expect(",]") == "]":
+            return
+
+
+def json_dumps(data):
+    # Compact single-line JSON. This always uses the json module: orjson
+    # leaves out the spaces after separators and does not escape non-ASCII
+    # characters, so --nl output would depend on whether it is installed.
+    return json.dumps(data, default=repr)
+
+
+def json_dumps_item(data, indent=2):
+    # data serialized as an item of an indented JSON array, with every line
+    # already indented. Dumping [data] and stripping the brackets avoids
+    # re-indenting the output afterwards.
+    return json.dumps([data], indent=indent, default=repr)[2:-2]
+
+
+def json_loads(s):
+    # orjson is only used for reading JSON, which does not change any output
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # e.g. integers larger than 64 bits or NaN, which json accepts
+            pass
+    return json.loads(s)
@@ -32,6 +32,9 @@ setup(
         google-drive-to-sqlite=google_drive_to_sqlite.cli:cli
     """,
     install_requires=["click", "httpx", "sqlite-utils"],
-    extras_require={"test": ["pytest", "pytest-httpx", "pytest-mock", "cogapp"]},
-    python_requires=">=3.6",
+    extras_require={
+        "test": ["pytest", "pytest-httpx", "pytest-mock", "cogapp"],
+        "orjson": ["orjson"],
+    },
+    python_requires=">=3.7",
 )
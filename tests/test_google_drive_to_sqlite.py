@@ -1,11 +1,36 @@
 from click.testing import CliRunner
+import google_drive_to_sqlite.cli
+import google_drive_to_sqlite.utils
 from google_drive_to_sqlite.cli import cli, DEFAULT_FIELDS
+from google_drive_to_sqlite.utils import (
+    APIClient,
+    AsyncAPIClient,
+    CrawlState,
+    RateLimiter,
+    Stats,
+    save_files_and_folders,
+    file_columns,
+    files_in_folder_recursive,
+    files_in_folder_recursive_async,
+    iter_json_array,
+    json_dumps,
+    json_dumps_item,
+    json_loads,
+    paginate_files,
+    paginate_files_async,
+)
+import asyncio
+import hashlib
 import httpx
+import io
 import json
+import os
 import pathlib
+import pstats
 import pytest
 import re
 import stat
+import textwrap
 import sqlite_utils
 
 TOKEN_REQUEST_CONTENT = (
@@ -19,6 +44,15 @@ AUTH_JSON = {"google-drive-to-sqlite": {"refresh_token": "rtoken"}}
 FOLDER_AND_CHILDREN_JSON_PATH = (
     pathlib.Path(__file__).parent / "folder-and-children.json"
 )
+# Tables created by the files command, including FTS on name and the
+# closure table for the folder hierarchy
+TABLES = {"drive_folders", "drive_files", "drive_users", "drive_folder_closure"} | {
+    "{}_fts{}".format(table, suffix)
+    for table in ("drive_folders", "drive_files")
+    for suffix in ("", "_data", "_idx", "_docsize", "_config")
+}
+# A drive_files row with every column from DEFAULT_FIELDS set to None
+EMPTY_ROW = {column: None for column in file_columns(DEFAULT_FIELDS)}
 
 
 @pytest.mark.parametrize(
@@ -178,7 +212,12 @@ def test_get_plain_text(httpx_mock):
         ),
     ),
 )
-def test_get_paginated(httpx_mock, opts, expected_output):
+@pytest.mark.parametrize("use_orjson", (False, True))
+def test_get_paginated(httpx_mock, mocker, opts, expected_output, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        mocker.patch("google_drive_to_sqlite.utils.orjson", None)
     httpx_mock.add_response(
         url="https://www.googleapis.com/oauth2/v4/token",
         method="POST",
@@ -280,10 +319,10 @@ def test_files_basic(httpx_mock, opts, extra_qs, use_db):
         if use_db:
             rows = list(sqlite_utils.Database("test.db")["drive_files"].rows)
             assert rows == [
-                {"id": "1", "_parent": None, "_owner": None, "lastModifyingUser": None},
-                {"id": "2", "_parent": None, "_owner": None, "lastModifyingUser": None},
-                {"id": "3", "_parent": None, "_owner": None, "lastModifyingUser": None},
-                {"id": "4", "_parent": None, "_owner": None, "lastModifyingUser": None},
+                dict(EMPTY_ROW, id="1"),
+                dict(EMPTY_ROW, id="2"),
+                dict(EMPTY_ROW, id="3"),
+                dict(EMPTY_ROW, id="4"),
             ]
         else:
             results = json.loads(result.output)
@@ -559,15 +598,11 @@ def test_files_input(httpx_mock, opt, input):
         assert len(httpx_mock.get_requests()) == 0
         assert result.exit_code == 0
         db = sqlite_utils.Database("test.db")
-        assert set(db.table_names()) == {
-            "drive_folders",
-            "drive_files",
-            "drive_users",
-        }
+        assert set(db.table_names()) == TABLES
         rows = list(db["drive_files"].rows)
         assert rows == [
-            {"id": "one", "_parent": None, "_owner": None, "lastModifyingUser": None},
-            {"id": "two", "_parent": None, "_owner": None, "lastModifyingUser": None},
+            dict(EMPTY_ROW, id="one"),
+            dict(EMPTY_ROW, id="two"),
         ]
 
 
@@ -580,45 +615,102 @@ def test_files_input_real_example(httpx_mock):
         assert len(httpx_mock.get_requests()) == 0
         assert result.exit_code == 0
         db = sqlite_utils.Database("test.db")
-        assert set(db.table_names()) == {
-            "drive_folders",
-            "drive_files",
-            "drive_users",
-        }
-        schema = db.schema
-        assert (
-            schema
-            == "CREATE TABLE [drive_users] (\n   [permissionId] TEXT PRIMARY KEY\n,"
-            " [kind] TEXT, [displayName] TEXT, [photoLink] TEXT, [me] INTEGER,"
-            " [emailAddress] TEXT);\nCREATE TABLE [drive_folders] (\n   [id] TEXT"
-            " PRIMARY KEY,\n   [_parent] TEXT,\n   [_owner] TEXT,\n  "
-            " [lastModifyingUser] TEXT, [kind] TEXT, [name] TEXT, [mimeType] TEXT,"
-            " [starred] INTEGER, [trashed] INTEGER, [explicitlyTrashed] INTEGER,"
-            " [parents] TEXT, [spaces] TEXT, [version] TEXT, [webViewLink] TEXT,"
-            " [iconLink] TEXT, [hasThumbnail] INTEGER, [thumbnailVersion] TEXT,"
-            " [viewedByMe] INTEGER, [createdTime] TEXT, [modifiedTime] TEXT,"
-            " [modifiedByMe] INTEGER, [shared] INTEGER, [ownedByMe] INTEGER,"
-            " [viewersCanCopyContent] INTEGER, [copyRequiresWriterPermission]"
-            " INTEGER, [writersCanShare] INTEGER, [folderColorRgb] TEXT,"
-            " [quotaBytesUsed] TEXT, [isAppAuthorized] INTEGER, [linkShareMetadata]"
-            " TEXT,\n   FOREIGN KEY([_parent]) REFERENCES [drive_folders]([id]),\n  "
-            " FOREIGN KEY([_owner]) REFERENCES [drive_users]([permissionId]),\n  "
-            " FOREIGN KEY([lastModifyingUser]) REFERENCES"
-            " [drive_users]([permissionId])\n);\nCREATE TABLE [drive_files] (\n  "
-            " [id] TEXT PRIMARY KEY,\n   [_parent] TEXT,\n   [_owner] TEXT,\n  "
-            " [lastModifyingUser] TEXT, [kind] TEXT, [name] TEXT, [mimeType] TEXT,"
-            " [starred] INTEGER, [trashed] INTEGER, [explicitlyTrashed] INTEGER,"
-            " [parents] TEXT, [spaces] TEXT, [version] TEXT, [webViewLink] TEXT,"
-            " [iconLink] TEXT, [hasThumbnail] INTEGER, [thumbnailVersion] TEXT,"
-            " [viewedByMe] INTEGER, [createdTime] TEXT, [modifiedTime] TEXT,"
-            " [modifiedByMe] INTEGER, [shared] INTEGER, [ownedByMe] INTEGER,"
-            " [viewersCanCopyContent] INTEGER, [copyRequiresWriterPermission]"
-            " INTEGER, [writersCanShare] INTEGER, [quotaBytesUsed] TEXT,"
-            " [isAppAuthorized] INTEGER, [linkShareMetadata] TEXT,\n   FOREIGN"
-            " KEY([_parent]) REFERENCES [drive_folders]([id]),\n   FOREIGN"
-            " KEY([_owner]) REFERENCES [drive_users]([permissionId]),\n   FOREIGN"
-            " KEY([lastModifyingUser]) REFERENCES [drive_users]([permissionId])\n);"
+        assert set(db.table_names()) == TABLES
+        # Columns are declared up front from DEFAULT_FIELDS, with types
+        file_columns_sql = (
+            "(\n"
+            + ",\n".join(
+                (
+                    "   [id] TEXT PRIMARY KEY",
+                    "   [_parent] TEXT",
+                    "   [_owner] TEXT",
+                    "   [lastModifyingUser] TEXT",
+                    "   [kind] TEXT",
+                    "   [name] TEXT",
+                    "   [mimeType] TEXT",
+                    "   [starred] INTEGER",
+                    "   [trashed] INTEGER",
+                    "   [explicitlyTrashed] INTEGER",
+                    "   [parents] TEXT",
+                    "   [spaces] TEXT",
+                    "   [version] INTEGER",
+                    "   [webViewLink] TEXT",
+                    "   [iconLink] TEXT",
+                    "   [hasThumbnail] INTEGER",
+                    "   [thumbnailVersion] INTEGER",
+                    "   [viewedByMe] INTEGER",
+                    "   [createdTime] TEXT",
+                    "   [modifiedTime] TEXT",
+                    "   [modifiedByMe] INTEGER",
+                    "   [shared] INTEGER",
+                    "   [ownedByMe] INTEGER",
+                    "   [viewersCanCopyContent] INTEGER",
+                    "   [copyRequiresWriterPermission] INTEGER",
+                    "   [writersCanShare] INTEGER",
+                    "   [folderColorRgb] TEXT",
+                    "   [quotaBytesUsed] INTEGER",
+                    "   [isAppAuthorized] INTEGER",
+                    "   [linkShareMetadata] TEXT",
+                    "   FOREIGN KEY([_parent]) REFERENCES [drive_folders]([id])",
+                    "   FOREIGN KEY([_owner]) REFERENCES [drive_users]([permissionId])",
+                    "   FOREIGN KEY([lastModifyingUser]) REFERENCES [drive_users]([permissionId])",
+                )
+            )
+            + "\n);"
+        )
+        assert ";\n".join(
+            db[table].schema
+            for table in ("drive_users", "drive_folders", "drive_files")
+        ) + ";" == (
+            "CREATE TABLE [drive_users] (\n"
+            "   [permissionId] TEXT PRIMARY KEY,\n"
+            "   [kind] TEXT,\n"
+            "   [displayName] TEXT,\n"
+            "   [photoLink] TEXT,\n"
+            "   [me] INTEGER,\n"
+            "   [emailAddress] TEXT\n"
+            ");\n"
+            "CREATE TABLE [drive_folders] "
+            + file_columns_sql.replace(
+                "[_parent] TEXT,", "[_parent] TEXT,\n   [_path] TEXT,"
+            )
+            + "\n"
+            "CREATE TABLE [drive_files] " + file_columns_sql
         )
+        for table in ("drive_folders", "drive_files"):
+            assert [index.columns for index in db[table].indexes] == [
+                ["modifiedTime"],
+                ["mimeType"],
+                ["lastModifyingUser"],
+                ["_owner"],
+                ["_parent"],
+                ["id"],
+            ]
+            assert db[table].detect_fts() == "{}_fts".format(table)
+        assert [row["name"] for row in db["drive_folders"].search("two")] == ["two"]
+        assert list(
+            db["drive_folder_closure"].rows_where(
+                "ancestor = ?",
+                ["1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j"],
+                order_by="depth, descendant",
+            )
+        ) == [
+            {
+                "ancestor": "1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j",
+                "descendant": "1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j",
+                "depth": 0,
+            },
+            {
+                "ancestor": "1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j",
+                "descendant": "113Wb_KLL1dtgx3vpeRfSTOYIUDf3QnnN",
+                "depth": 1,
+            },
+            {
+                "ancestor": "1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j",
+                "descendant": "1FYLDMMXi1-gGjxg8dLmvbiixDuR8-FZ3",
+                "depth": 1,
+            },
+        ]
         files_rows = list(db["drive_files"].rows)
         folders_rows = list(db["drive_folders"].rows)
         users_rows = list(db["drive_users"].rows)
@@ -636,11 +728,11 @@ def test_files_input_real_example(httpx_mock):
                 "explicitlyTrashed": 0,
                 "parents": '["113Wb_KLL1dtgx3vpeRfSTOYIUDf3QnnN"]',
                 "spaces": '["drive"]',
-                "version": "2",
+                "version": 2,
                 "webViewLink": "https://drive.google.com/file/d/1Xdqfeoi8B8YJJR0y-_oQlHYpjHHzD5a-/view?usp=drivesdk",
                 "iconLink": "https://drive-thirdparty.googleusercontent.com/16/type/text/csv",
                 "hasThumbnail": 0,
-                "thumbnailVersion": "0",
+                "thumbnailVersion": 0,
                 "viewedByMe": 1,
                 "createdTime": "2022-02-19T04:25:16.517Z",
                 "modifiedTime": "2020-11-11T18:10:31.000Z",
@@ -650,7 +742,8 @@ def test_files_input_real_example(httpx_mock):
                 "viewersCanCopyContent": 1,
                 "copyRequiresWriterPermission": 0,
                 "writersCanShare": 1,
-                "quotaBytesUsed": "1070506",
+                "folderColorRgb": None,
+                "quotaBytesUsed": 1070506,
                 "isAppAuthorized": 0,
                 "linkShareMetadata": '{"securityUpdateEligible": false, "securityUpdateEnabled": true}',
             }
@@ -659,6 +752,7 @@ def test_files_input_real_example(httpx_mock):
             {
                 "id": "1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j",
                 "_parent": "0AK1CICIR8ECDUk9PVA",
+                "_path": "test-folder",
                 "_owner": "16974643384157631322",
                 "lastModifyingUser": "16974643384157631322",
                 "kind": "drive#file",
@@ -669,11 +763,11 @@ def test_files_input_real_example(httpx_mock):
                 "explicitlyTrashed": 0,
                 "parents": '["0AK1CICIR8ECDUk9PVA"]',
                 "spaces": '["drive"]',
-                "version": "4",
+                "version": 4,
                 "webViewLink": "https://drive.google.com/drive/folders/1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j",
                 "iconLink": "https://drive-thirdparty.googleusercontent.com/16/type/application/vnd.google-apps.folder",
                 "hasThumbnail": 0,
-                "thumbnailVersion": "0",
+                "thumbnailVersion": 0,
                 "viewedByMe": 1,
                 "createdTime": "2022-02-19T04:22:24.589Z",
                 "modifiedTime": "2022-02-19T04:22:24.589Z",
@@ -684,13 +778,14 @@ def test_files_input_real_example(httpx_mock):
                 "copyRequiresWriterPermission": 0,
                 "writersCanShare": 1,
                 "folderColorRgb": "#8f8f8f",
-                "quotaBytesUsed": "0",
+                "quotaBytesUsed": 0,
                 "isAppAuthorized": 0,
                 "linkShareMetadata": '{"securityUpdateEligible": false, "securityUpdateEnabled": true}',
             },
             {
                 "id": "1FYLDMMXi1-gGjxg8dLmvbiixDuR8-FZ3",
                 "_parent": "1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j",
+                "_path": "test-folder/two",
                 "_owner": "16974643384157631322",
                 "lastModifyingUser": "16974643384157631322",
                 "kind": "drive#file",
@@ -701,11 +796,11 @@ def test_files_input_real_example(httpx_mock):
                 "explicitlyTrashed": 0,
                 "parents": '["1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j"]',
                 "spaces": '["drive"]',
-                "version": "1",
+                "version": 1,
                 "webViewLink": "https://drive.google.com/drive/folders/1FYLDMMXi1-gGjxg8dLmvbiixDuR8-FZ3",
                 "iconLink": "https://drive-thirdparty.googleusercontent.com/16/type/application/vnd.google-apps.folder",
                 "hasThumbnail": 0,
-                "thumbnailVersion": "0",
+                "thumbnailVersion": 0,
                 "viewedByMe": 1,
                 "createdTime": "2022-02-19T04:22:38.714Z",
                 "modifiedTime": "2022-02-19T04:22:38.714Z",
@@ -716,13 +811,14 @@ def test_files_input_real_example(httpx_mock):
                 "copyRequiresWriterPermission": 0,
                 "writersCanShare": 1,
                 "folderColorRgb": "#8f8f8f",
-                "quotaBytesUsed": "0",
+                "quotaBytesUsed": 0,
                 "isAppAuthorized": 0,
                 "linkShareMetadata": '{"securityUpdateEligible": false, "securityUpdateEnabled": true}',
             },
             {
                 "id": "113Wb_KLL1dtgx3vpeRfSTOYIUDf3QnnN",
                 "_parent": "1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j",
+                "_path": "test-folder/one",
                 "_owner": "16974643384157631322",
                 "lastModifyingUser": "16974643384157631322",
                 "kind": "drive#file",
@@ -733,11 +829,11 @@ def test_files_input_real_example(httpx_mock):
                 "explicitlyTrashed": 0,
                 "parents": '["1dbccBzomcvEUGdnoj8-9QG1yHxS0R-_j"]',
                 "spaces": '["drive"]',
-                "version": "2",
+                "version": 2,
                 "webViewLink": "https://drive.google.com/drive/folders/113Wb_KLL1dtgx3vpeRfSTOYIUDf3QnnN",
                 "iconLink": "https://drive-thirdparty.googleusercontent.com/16/type/application/vnd.google-apps.folder",
                 "hasThumbnail": 0,
-                "thumbnailVersion": "0",
+                "thumbnailVersion": 0,
                 "viewedByMe": 1,
                 "createdTime": "2022-02-19T04:22:33.581Z",
                 "modifiedTime": "2022-02-19T04:22:33.581Z",
@@ -748,7 +844,7 @@ def test_files_input_real_example(httpx_mock):
                 "copyRequiresWriterPermission": 0,
                 "writersCanShare": 1,
                 "folderColorRgb": "#8f8f8f",
-                "quotaBytesUsed": "0",
+                "quotaBytesUsed": 0,
                 "isAppAuthorized": 0,
                 "linkShareMetadata": '{"securityUpdateEligible": false, "securityUpdateEnabled": true}',
             },
@@ -826,3 +922,1800 @@ def test_files_retry_on_transport_error(
             + "  Got {}, retrying\n".format(exception.__name__)
             + "GET: https://www.googleapis.com/drive/v3/about?fields=*\n"
         )
+
+
+def test_api_client_reuses_connection_pool(httpx_mock):
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/oauth2/v4/token",
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/about", json={"kind": "drive#about"}
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/about", json={"kind": "drive#about"}
+    )
+    with APIClient("rtoken", "client_id", "client_secret") as client:
+        http = client.http
+        for _ in range(2):
+            assert client.get("https://www.googleapis.com/drive/v3/about").json() == {
+                "kind": "drive#about"
+            }
+        # Same pooled client used for every request
+        assert client.http is http
+        assert not http.is_closed
+    assert http.is_closed
+    assert len(httpx_mock.get_requests()) == 3
+
+
+def test_files_folder_concurrency(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url=re.compile(".*/files/folder1.*"),
+        json={"id": "folder1", "mimeType": "application/vnd.google-apps.folder"},
+    )
+    # folder1 contains sub1 and sub2, each of which contain one doc
+    children = {
+        "folder1": [
+            {"id": "sub1", "mimeType": "application/vnd.google-apps.folder"},
+            {"id": "sub2", "mimeType": "application/vnd.google-apps.folder"},
+        ],
+        "sub1": [{"id": "doc1", "mimeType": "doc"}],
+        "sub2": [{"id": "doc2", "mimeType": "doc"}],
+    }
+    for folder_id, files in children.items():
+        httpx_mock.add_response(
+            url=re.compile(".*q=%22{}%22.*".format(folder_id)),
+            json={"nextPageToken": None, "files": files},
+        )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        args = ["files", "--folder", "folder1", "--json", "--concurrency", "4"]
+        result = runner.invoke(cli, args, catch_exceptions=False)
+        assert result.exit_code == 0
+        assert len(httpx_mock.get_requests()) == 5
+        results = json.loads(result.output)
+        assert results[0]["id"] == "folder1"
+        assert {r["id"] for r in results} == {
+            "folder1",
+            "sub1",
+            "sub2",
+            "doc1",
+            "doc2",
+        }
+
+
+def test_files_folder_batches_sub_folders(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        json={"id": "folder1", "mimeType": "application/vnd.google-apps.folder"},
+    )
+    httpx_mock.add_response(
+        json={
+            "nextPageToken": None,
+            "files": [
+                {
+                    "id": "sub1",
+                    "mimeType": "application/vnd.google-apps.folder",
+                    "parents": ["folder1"],
+                },
+                {
+                    "id": "sub2",
+                    "mimeType": "application/vnd.google-apps.folder",
+                    "parents": ["folder1"],
+                },
+            ],
+        }
+    )
+    # Both sub-folders should be fetched using a single query
+    httpx_mock.add_response(
+        json={
+            "nextPageToken": None,
+            "files": [
+                {"id": "doc2", "mimeType": "doc", "parents": ["sub2"]},
+                {"id": "doc1", "mimeType": "doc", "parents": ["sub1"]},
+            ],
+        }
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        args = ["files", "--folder", "folder1", "--json"]
+        result = runner.invoke(cli, args)
+        assert result.exit_code == 0
+        _, _, folder1_request, subfolders_request = httpx_mock.get_requests()
+        assert folder1_request.url.params["q"] == '"folder1" in parents'
+        assert (
+            subfolders_request.url.params["q"]
+            == '"sub1" in parents or "sub2" in parents'
+        )
+        # Results are grouped back in the order of their parent folders
+        assert [r["id"] for r in json.loads(result.output)] == [
+            "folder1",
+            "sub1",
+            "sub2",
+            "doc1",
+            "doc2",
+        ]
+
+
+def test_files_incremental(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/changes/startPageToken",
+        json={"startPageToken": "100"},
+    )
+    httpx_mock.add_response(
+        json={
+            "nextPageToken": None,
+            "files": [
+                {"id": "doc1", "mimeType": "doc", "name": "One"},
+                {"id": "doc2", "mimeType": "doc", "name": "Two"},
+            ],
+        },
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(cli, ["files", "test.db", "--incremental"])
+        assert result.exit_code == 0
+        db = sqlite_utils.Database("test.db")
+        assert [r["id"] for r in db["drive_files"].rows] == ["doc1", "doc2"]
+        assert list(db["drive_state"].rows) == [
+            {"key": "changes_page_token", "value": "100"}
+        ]
+        # Second run should only fetch changes since that token
+        httpx_mock.reset(assert_all_responses_were_requested=True)
+        httpx_mock.add_response(
+            method="POST",
+            json={"access_token": "atoken"},
+        )
+        httpx_mock.add_response(
+            url=re.compile(".*/changes.*pageToken=100.*"),
+            json={
+                "nextPageToken": "101",
+                "changes": [
+                    {"fileId": "doc1", "removed": True},
+                ],
+            },
+        )
+        httpx_mock.add_response(
+            url=re.compile(".*/changes.*pageToken=101.*"),
+            json={
+                "newStartPageToken": "102",
+                "changes": [
+                    {
+                        "fileId": "doc2",
+                        "removed": False,
+                        "file": {"id": "doc2", "mimeType": "doc", "name": "Two v2"},
+                    },
+                    {
+                        "fileId": "doc3",
+                        "removed": False,
+                        "file": {"id": "doc3", "mimeType": "doc", "name": "Three"},
+                    },
+                ],
+            },
+        )
+        result = runner.invoke(cli, ["files", "test.db", "--incremental", "-v"])
+        assert result.exit_code == 0
+        assert "2 changed, 1 removed" in result.output
+        assert [(r["id"], r["name"]) for r in db["drive_files"].rows] == [
+            ("doc2", "Two v2"),
+            ("doc3", "Three"),
+        ]
+        assert list(db["drive_state"].rows) == [
+            {"key": "changes_page_token", "value": "102"}
+        ]
+
+
+def test_files_incremental_invalid_options():
+    runner = CliRunner()
+    result = runner.invoke(cli, ["files", "test.db", "--incremental", "--starred"])
+    assert result.exit_code == 1
+    assert result.output == (
+        "Error: --incremental cannot be combined with filtering, "
+        "output or import options\n"
+    )
+
+
+def test_files_resume(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        json={
+            "nextPageToken": "p2",
+            "files": [{"id": "a{}".format(i)} for i in range(100)],
+        },
+    )
+    httpx_mock.add_response(
+        url=re.compile(".*pageToken=p2.*"),
+        json={
+            "nextPageToken": "p3",
+            "files": [{"id": "b{}".format(i)} for i in range(100)],
+        },
+    )
+    httpx_mock.add_response(
+        url=re.compile(".*pageToken=p3.*"),
+        json={"error": {"code": 500, "message": "Backend Error"}},
+        status_code=500,
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(cli, ["files", "test.db"])
+        assert result.exit_code == 1
+        db = sqlite_utils.Database("test.db")
+        assert db["drive_files"].count == 200
+        assert json.loads(db["drive_state"].get("checkpoint")["value"]) == {
+            "params": {"folder": None, "q": ""},
+            "page_token": "p2",
+        }
+        # --resume should start from the last committed page
+        httpx_mock.reset(assert_all_responses_were_requested=False)
+        httpx_mock.add_response(
+            method="POST",
+            json={"access_token": "atoken"},
+        )
+        httpx_mock.add_response(
+            url=re.compile(".*pageToken=p2.*"),
+            json={
+                "nextPageToken": "p3",
+                "files": [{"id": "b{}".format(i)} for i in range(100)],
+            },
+        )
+        httpx_mock.add_response(
+            url=re.compile(".*pageToken=p3.*"),
+            json={"files": [{"id": "c1"}]},
+        )
+        result = runner.invoke(cli, ["files", "test.db", "--resume"])
+        assert result.exit_code == 0
+        _, p2_request, p3_request = httpx_mock.get_requests()
+        assert p2_request.url.params["pageToken"] == "p2"
+        assert p3_request.url.params["pageToken"] == "p3"
+        assert db["drive_files"].count == 201
+        # Checkpoint is cleared once the crawl completes
+        assert db["drive_state"].count == 0
+
+
+def test_files_resume_folder(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url=re.compile(".*/files/folder1.*"),
+        json={"id": "folder1", "mimeType": "application/vnd.google-apps.folder"},
+    )
+    httpx_mock.add_response(
+        url=re.compile(".*q=%22sub2%22.*"),
+        json={"files": [{"id": "doc2", "mimeType": "doc", "parents": ["sub2"]}]},
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        # Simulate a crawl that was interrupted with only sub2 left to fetch
+        db = sqlite_utils.Database("test.db")
+        state = CrawlState({"folder": "folder1", "q": ""})
+        state.add_folders(["sub2"])
+        with db.conn:
+            state.save(db)
+        result = runner.invoke(
+            cli, ["files", "test.db", "--folder", "folder1", "--resume"]
+        )
+        assert result.exit_code == 0
+        assert len(httpx_mock.get_requests()) == 3
+        assert [r["id"] for r in db["drive_files"].rows] == ["doc2"]
+        assert db["drive_state_frontier"].count == 0
+        # Resuming a different crawl is an error
+        state.add_folders(["sub3"])
+        with db.conn:
+            state.save(db)
+        result = runner.invoke(cli, ["files", "test.db", "--starred", "--resume"])
+        assert result.exit_code == 1
+        assert result.output == (
+            'Error: Checkpoint is for a different crawl: {"folder": "folder1", "q": ""}\n'
+        )
+
+
+def test_async_api_client_paginate_files(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    # First request fails with an expired token, triggering a refresh
+    httpx_mock.add_response(status_code=401, json={"error": {"code": 401}})
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken2"},
+    )
+    httpx_mock.add_response(
+        json={"nextPageToken": "next", "files": [{"id": 1}, {"id": 2}]},
+    )
+    httpx_mock.add_response(
+        json={"files": [{"id": 3}]},
+    )
+
+    async def run():
+        async with AsyncAPIClient("rtoken", "id", "secret") as client:
+            files = [file async for file in paginate_files_async(client, q="x")]
+            return files, client.http
+
+    files, http = asyncio.run(run())
+    assert files == [{"id": 1}, {"id": 2}, {"id": 3}]
+    assert http.is_closed
+    requests = httpx_mock.get_requests()
+    assert len(requests) == 5
+    assert requests[-1].headers["authorization"] == "Bearer atoken2"
+    assert requests[-1].url.params["pageToken"] == "next"
+
+
+def test_files_in_folder_recursive_async(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    children = {
+        "folder1": [
+            {
+                "id": "sub1",
+                "mimeType": "application/vnd.google-apps.folder",
+                "parents": ["folder1"],
+            },
+            {"id": "doc1", "mimeType": "doc", "parents": ["folder1"]},
+        ],
+        "sub1": [{"id": "doc2", "mimeType": "doc", "parents": ["sub1"]}],
+    }
+    for folder_id, files in children.items():
+        httpx_mock.add_response(
+            url=re.compile(".*q=%22{}%22.*".format(folder_id)),
+            json={"files": files},
+        )
+
+    async def run():
+        async with AsyncAPIClient("rtoken", "id", "secret") as client:
+            return [
+                file["id"]
+                async for file in files_in_folder_recursive_async(
+                    client, "folder1", fields=["id", "mimeType", "parents"]
+                )
+            ]
+
+    assert asyncio.run(run()) == ["sub1", "doc1", "doc2"]
+
+
+@pytest.mark.parametrize("silent", (False, True))
+def test_download_concurrency(httpx_mock, silent):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?alt=media",
+        content="this is text",
+        headers={"content-type": "text/plain"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file2?alt=media",
+        status_code=404,
+        content="File not found: file2",
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file3?alt=media",
+        content="this is gif",
+        headers={"content-type": "image/gif"},
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        args = ["download", "file1", "file2", "file3", "--concurrency", "3"]
+        if silent:
+            args.append("-s")
+        result = runner.invoke(cli, args)
+        # One failure should not stop the other downloads
+        assert result.exit_code == 1
+        assert open("file1.txt").read() == "this is text"
+        assert open("file3.gif").read() == "this is gif"
+        assert "Failed file2: 404: File not found: file2" in result.stderr
+        assert result.stderr.endswith("Error: 1 of 3 files failed\n")
+        if silent:
+            assert result.stdout == ""
+            assert "2 of 3 files" not in result.stderr
+        else:
+            assert "2 of 3 files, 23 bytes" in result.stderr
+
+
+def test_export_concurrency(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    for file_id in ("file1", "file2"):
+        httpx_mock.add_response(
+            url="https://www.googleapis.com/drive/v3/files/{}/export"
+            "?mimeType=application%2Fpdf".format(file_id),
+            content="pdf of {}".format(file_id),
+            headers={"content-type": "application/pdf"},
+        )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file3/export"
+        "?mimeType=application%2Fpdf",
+        status_code=403,
+        content="Export only supports Docs Editors files.",
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(
+            cli, ["export", "pdf", "file1", "file2", "file3", "--concurrency", "2"]
+        )
+        assert result.exit_code == 1
+        assert open("file1-export.pdf").read() == "pdf of file1"
+        assert open("file2-export.pdf").read() == "pdf of file2"
+        # Per-file timings
+        assert re.search(r"file1-export.pdf: 12 bytes in \d+\.\d\ds", result.stderr)
+        assert re.search(r"file2-export.pdf: 12 bytes in \d+\.\d\ds", result.stderr)
+        assert (
+            "Failed file3-export: 403: Export only supports Docs Editors files."
+            in result.stderr
+        )
+        assert result.stderr.endswith("Error: 1 of 3 files failed\n")
+
+
+RATE_LIMIT_ERROR = {
+    "error": {
+        "errors": [
+            {
+                "domain": "usageLimits",
+                "reason": "userRateLimitExceeded",
+                "message": "User Rate Limit Exceeded",
+            }
+        ],
+        "code": 403,
+        "message": "User Rate Limit Exceeded",
+    }
+}
+
+
+@pytest.mark.parametrize(
+    "status_code,json_,headers,expected_sleep",
+    (
+        (429, {}, {"retry-after": "7"}, 7.0),
+        (403, RATE_LIMIT_ERROR, {}, None),
+    ),
+)
+def test_get_retries_rate_limit_errors(
+    httpx_mock, mocker, status_code, json_, headers, expected_sleep
+):
+    sleep = mocker.patch("google_drive_to_sqlite.utils.sleep")
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(status_code=status_code, json=json_, headers=headers)
+    httpx_mock.add_response(json={"kind": "drive#about"})
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(
+            cli, ["get", "https://www.googleapis.com/drive/v3/about", "-v"]
+        )
+        assert result.exit_code == 0
+        assert json.loads(result.stdout.split("\n", 1)[1]) == {"kind": "drive#about"}
+    assert len(httpx_mock.get_requests()) == 3
+    delay = sleep.call_args_list[0][0][0]
+    if expected_sleep is not None:
+        assert delay == expected_sleep
+    else:
+        # Exponential backoff with jitter, first attempt
+        assert 1 <= delay <= 2
+    assert (
+        "  Got {}, retrying in {:.1f}s, rate now 10.0 requests/second\n".format(
+            status_code, delay
+        )
+        in result.stderr
+    )
+
+
+def test_get_does_not_retry_other_403_errors(httpx_mock, mocker):
+    sleep = mocker.patch("google_drive_to_sqlite.utils.sleep")
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        status_code=403,
+        json={"error": {"errors": [{"reason": "forbidden"}], "code": 403}},
+    )
+    with APIClient("rtoken", "id", "secret") as client:
+        response = client.get("https://www.googleapis.com/drive/v3/files/x")
+    assert response.status_code == 403
+    assert len(httpx_mock.get_requests()) == 2
+    sleep.assert_not_called()
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=10, min_rate=1, max_rate=11)
+    # Initial burst of up to one second's worth of requests
+    assert [limiter.reserve() for _ in range(10)] == [0] * 10
+    assert limiter.reserve() == pytest.approx(0.1, abs=0.01)
+    # Halved on throttling, down to min_rate
+    limiter.throttled()
+    assert limiter.rate == 5
+    for _ in range(5):
+        limiter.throttled()
+    assert limiter.rate == 1
+    # Then grows again one step at a time, up to max_rate
+    limiter.success()
+    assert limiter.rate == 2
+    for _ in range(1000):
+        limiter.success()
+    assert limiter.rate == 11
+
+
+def test_save_files_and_folders_bulk_users(mocker):
+    db = sqlite_utils.Database(memory=True)
+    alice = {"permissionId": "a", "displayName": "Alice"}
+    bob = {"permissionId": "b", "displayName": "Bob", "emailAddress": "b@example.com"}
+    files = [
+        {"id": "1", "owners": [alice], "lastModifyingUser": bob},
+        {"id": "2", "owners": [bob], "lastModifyingUser": alice},
+        {"id": "3", "owners": [alice], "lastModifyingUser": {"displayName": ""}},
+    ]
+    insert_all = mocker.spy(sqlite_utils.db.Table, "insert_all")
+    save_files_and_folders(db, files)
+    # One insert_all() for the users, one each for folders and files
+    assert [call.args[0].name for call in insert_all.call_args_list] == [
+        "drive_users",
+        "drive_folders",
+        "drive_files",
+    ]
+    assert list(db["drive_users"].rows) == [
+        {"permissionId": "b", "displayName": "Bob", "emailAddress": "b@example.com"},
+        {"permissionId": "a", "displayName": "Alice", "emailAddress": None},
+    ]
+    assert [
+        (row["id"], row["_owner"], row["lastModifyingUser"])
+        for row in db["drive_files"].rows
+    ] == [("1", "a", "b"), ("2", "b", "a"), ("3", "a", None)]
+
+
+def test_files_bulk_batch_size(mocker):
+    insert_all = mocker.spy(sqlite_utils.db.Table, "insert_all")
+    pragmas = []
+    original_save = google_drive_to_sqlite.cli.save_files_and_folders
+
+    def save_files_and_folders(db, *args, **kwargs):
+        # Record the settings in use during the import
+        pragmas.append(
+            (
+                db.execute("pragma journal_mode").fetchone()[0],
+                db.execute("pragma synchronous").fetchone()[0],
+            )
+        )
+        counts = original_save(db, *args, **kwargs)
+        indexes.append([index.columns for index in db["drive_files"].indexes])
+        return counts
+
+    indexes = []
+    mocker.patch(
+        "google_drive_to_sqlite.cli.save_files_and_folders", save_files_and_folders
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        input = "\n".join(
+            json.dumps({"id": str(i), "name": "file {}".format(i)}) for i in range(5)
+        )
+        result = runner.invoke(
+            cli,
+            ["files", "test.db", "--import-nl", "-", "--bulk", "--batch-size", "2"],
+            input=input,
+        )
+        assert result.exit_code == 0
+        db = sqlite_utils.Database("test.db")
+        assert db["drive_files"].count == 5
+        # Batches of 2, 2 and 1
+        assert [
+            len(call.args[1])
+            for call in insert_all.call_args_list
+            if call.args[0].name == "drive_files"
+        ] == [2, 2, 1]
+        # WAL and synchronous=NORMAL during the import, then restored
+        assert pragmas == [("wal", 1)]
+        assert db.execute("pragma journal_mode").fetchone()[0] == "delete"
+        # Indexes are only created after the rows have been loaded
+        assert indexes == [[["id"]]]
+        assert len(db["drive_files"].indexes) == 6
+        assert [row["id"] for row in db["drive_files"].search("3")] == ["3"]
+
+
+def test_files_skips_unchanged_rows(mocker):
+    runner = CliRunner(mix_stderr=False)
+    files = json.loads(FOLDER_AND_CHILDREN_JSON_PATH.read_text())
+    with runner.isolated_filesystem():
+        args = ["files", "test.db", "--import-nl", "-", "-v"]
+
+        def import_files(files):
+            return runner.invoke(
+                cli, args, input="\n".join(json.dumps(file) for file in files)
+            )
+
+        result = import_files(files)
+        assert result.exit_code == 0
+        assert result.stderr == "4 inserted, 0 updated, 0 unchanged\n"
+        # Running again should not write anything
+        execute = mocker.spy(sqlite_utils.Database, "execute")
+        result = import_files(files)
+        assert result.stderr == "0 inserted, 0 updated, 4 unchanged\n"
+        assert not [
+            call
+            for call in execute.call_args_list
+            if call.args[1].upper().startswith(("INSERT", "REPLACE"))
+        ]
+        # Change the version of one of them and add a new file
+        csv_file = [file for file in files if file["name"] == "sample.csv"][0]
+        csv_file["version"] = "3"
+        csv_file["name"] = "sample-renamed.csv"
+        files.append({"id": "new", "mimeType": "text/plain", "version": "1"})
+        result = import_files(files)
+        assert result.stderr == "1 inserted, 1 updated, 3 unchanged\n"
+        db = sqlite_utils.Database("test.db")
+        assert db["drive_files"].get(csv_file["id"])["name"] == "sample-renamed.csv"
+        # The name FTS index was updated for the replaced row
+        assert [row["id"] for row in db["drive_files"].search("csv")] == [
+            csv_file["id"]
+        ]
+        assert db["drive_files"].count == 2
+
+
+def test_save_files_and_folders_saves_newly_requested_fields():
+    db = sqlite_utils.Database(memory=True)
+    file = {
+        "id": "1",
+        "mimeType": "text/plain",
+        "version": "2",
+        "modifiedTime": "2022-01-01T00:00:00.000Z",
+    }
+    fields = ["id", "mimeType", "version", "modifiedTime"]
+    save_files_and_folders(db, [dict(file)], fields=fields)
+    # Same version and modifiedTime, but with fields that were not saved before
+    counts = save_files_and_folders(
+        db,
+        [dict(file, name="one.txt", size="12")],
+        fields=fields + ["name", "size"],
+    )
+    assert counts == {"inserted": 0, "updated": 1, "unchanged": 0}
+    row = db["drive_files"].get("1")
+    assert (row["name"], row["size"]) == ("one.txt", 12)
+    # Now that they are stored the row counts as unchanged
+    counts = save_files_and_folders(
+        db,
+        [dict(file, name="one.txt", size="12")],
+        fields=fields + ["name", "size"],
+    )
+    assert counts == {"inserted": 0, "updated": 0, "unchanged": 1}
+
+
+def test_save_files_and_folders_large_batch():
+    # More records in a batch than older SQLite allows query variables
+    db = sqlite_utils.Database(memory=True)
+    files = [
+        {"id": str(i), "version": "1", "modifiedTime": "2022-01-01T00:00:00.000Z"}
+        for i in range(1500)
+    ]
+    save_files_and_folders(db, [dict(file) for file in files], batch_size=1500)
+    counts = save_files_and_folders(db, [dict(file) for file in files], batch_size=1500)
+    assert counts == {"inserted": 0, "updated": 0, "unchanged": 1500}
+
+
+def test_save_files_and_folders_predeclared_schema(mocker):
+    db = sqlite_utils.Database(memory=True)
+    fields = ["id", "name", "size", "trashed", "owners"]
+    add_column = mocker.spy(sqlite_utils.db.Table, "add_column")
+    save_files_and_folders(
+        db,
+        [{"id": "1", "name": "one.txt", "size": "123", "trashed": False}],
+        fields=fields,
+    )
+    assert db["drive_files"].columns_dict == {
+        "id": str,
+        "_parent": str,
+        "_owner": str,
+        "lastModifyingUser": str,
+        "name": str,
+        "size": int,
+        "trashed": int,
+    }
+    assert not add_column.called
+    assert list(db["drive_files"].rows) == [
+        {
+            "id": "1",
+            "_parent": None,
+            "_owner": None,
+            "lastModifyingUser": None,
+            "name": "one.txt",
+            "size": 123,
+            "trashed": 0,
+        }
+    ]
+    # Keys that were not requested still get a column, typed where known
+    save_files_and_folders(
+        db,
+        [{"id": "2", "version": "4", "description": "Two"}],
+        fields=fields,
+    )
+    assert [call.args[1:] for call in add_column.call_args_list] == [
+        ("version", int),
+        ("description", str),
+    ]
+    assert db["drive_files"].get("2")["version"] == 4
+
+
+@pytest.mark.parametrize("chunk_size", (1, 3, 1024))
+@pytest.mark.parametrize(
+    "document,expected",
+    (
+        ("[]", []),
+        (" [ ] ", []),
+        ('[{"id": "1"}]', [{"id": "1"}]),
+        (
+            '[\n  {"id": "1", "name": "a, b]"},\n  {"id": "2", "size": 12345}\n]\n',
+            [{"id": "1", "name": "a, b]"}, {"id": "2", "size": 12345}],
+        ),
+        ("[1, 23, 456]", [1, 23, 456]),
+        ("[1, 2.5, -3e2, 4.25E-1 ]", [1, 2.5, -300.0, 0.425]),
+        ('[true, false, null, "a", 10]', [True, False, None, "a", 10]),
+    ),
+)
+def test_iter_json_array(document, expected, chunk_size):
+    assert list(iter_json_array(io.StringIO(document), chunk_size)) == expected
+
+
+@pytest.mark.parametrize("document", ("", "{}", "[1 2]", '[{"id": "1"}', "[1,"))
+def test_iter_json_array_invalid(document):
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array(io.StringIO(document), 2))
+
+
+def test_files_import_json_streams(mocker):
+    # Items reach save_files_and_folders() before the input is fully read
+    reads = []
+    file_chunks = iter(['[{"id": "1"}', ', {"id": "2"}', "]"])
+
+    class Input:
+        def read(self, size):
+            reads.append(size)
+            return next(file_chunks, "")
+
+    mocker.patch("google_drive_to_sqlite.cli.open", return_value=Input(), create=True)
+    seen = []
+    original_save = google_drive_to_sqlite.cli.save_files_and_folders
+
+    def save_files_and_folders(db, all, **kwargs):
+        def record():
+            for file in all:
+                seen.append((file["id"], len(reads)))
+                yield file
+
+        return original_save(db, record(), **kwargs)
+
+    mocker.patch(
+        "google_drive_to_sqlite.cli.save_files_and_folders", save_files_and_folders
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(cli, ["files", "test.db", "--import-json", "big.json"])
+        assert result.exit_code == 0, result.output
+        assert seen == [("1", 2), ("2", 3)]
+        assert [
+            row["id"] for row in sqlite_utils.Database("test.db")["drive_files"].rows
+        ] == ["1", "2"]
+
+
+@pytest.mark.parametrize("use_orjson", (False, True))
+def test_json_codec(mocker, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        mocker.patch("google_drive_to_sqlite.utils.orjson", None)
+    data = {"id": "1", "name": "caf\u00e9", "parents": ["a"], "size": 2**70}
+    # Output is the same whether or not orjson is installed
+    assert json_dumps(data) == json.dumps(data)
+    assert json_loads(json_dumps(data)) == data
+    assert json.loads("[{}]".format(json_dumps_item(data))) == [data]
+    # Values orjson rejects are still read by the json module
+    assert json_loads("[Infinity]") == [float("inf")]
+    # Items are indented ready to be placed inside an indented array
+    data = {"id": "1", "parents": ["a", "b"], "shared": False}
+    assert json_dumps_item(data) == textwrap.indent(json.dumps(data, indent=2), "  ")
+    assert json_dumps_item(data, indent=4) == textwrap.indent(
+        json.dumps(data, indent=4), "    "
+    )
+
+
+@pytest.mark.parametrize(
+    "opts,expected_fields",
+    (
+        (
+            ["--fields", "name,modifiedTime,md5Checksum"],
+            ["id", "mimeType", "name", "modifiedTime", "md5Checksum"],
+        ),
+        (
+            ["--fields", "-owners,-linkShareMetadata", "--fields", "+md5Checksum"],
+            [
+                field
+                for field in DEFAULT_FIELDS
+                if field not in ("owners", "linkShareMetadata")
+            ]
+            + ["md5Checksum"],
+        ),
+        (
+            ["--fields", "id,name", "--folder", "folder1"],
+            ["mimeType", "parents", "id", "name"],
+        ),
+        (
+            [
+                "--fields",
+                "id,name,owners(displayName,permissionId),capabilities/canEdit",
+            ],
+            [
+                "mimeType",
+                "id",
+                "name",
+                "owners(displayName,permissionId)",
+                "capabilities/canEdit",
+            ],
+        ),
+    ),
+)
+def test_files_fields(httpx_mock, opts, expected_fields):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    folder = "--folder" in opts
+    if folder:
+        httpx_mock.add_response(
+            url="https://www.googleapis.com/drive/v3/files/folder1?fields={}".format(
+                "%2C".join(expected_fields)
+            ),
+            json={
+                "id": "folder1",
+                "mimeType": "application/vnd.google-apps.folder",
+                "name": "Folder",
+            },
+        )
+    httpx_mock.add_response(
+        json={
+            "files": [
+                {"id": "1", "mimeType": "text/plain", "name": "one.txt"},
+            ]
+        },
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(cli, ["files", "test.db"] + opts)
+        assert result.exit_code == 0, result.output
+        files_request = httpx_mock.get_requests()[-1]
+        assert files_request.url.params["fields"] == "nextPageToken, files({})".format(
+            ",".join(expected_fields)
+        )
+        # The schema only has columns for the requested fields
+        db = sqlite_utils.Database("test.db")
+        assert list(db["drive_files"].columns_dict) == list(
+            file_columns(expected_fields)
+        )
+        # Nested selectors are saved to their top-level column
+        assert not [
+            column for column in db["drive_files"].columns_dict if "(" in column
+        ]
+        assert db["drive_files"].get("1")["name"] == "one.txt"
+
+
+def test_files_fields_invalid():
+    runner = CliRunner()
+    result = runner.invoke(cli, ["files", "test.db", "--fields", "name,-owners"])
+    assert result.exit_code == 1
+    assert result.output == (
+        "Error: --fields must either all start with + or -, or none of them\n"
+    )
+
+
+def test_get_fields(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(json={"files": [{"id": "1"}]})
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(
+            cli,
+            ["get", "/drive/v3/files", "--paginate", "files", "--fields", "id,name"],
+        )
+        assert result.exit_code == 0
+        assert (
+            httpx_mock.get_requests()[-1].url.params["fields"]
+            == "nextPageToken,files(id,name)"
+        )
+
+
+@pytest.mark.parametrize("concurrency", ("1", "2"))
+@pytest.mark.parametrize("with_metadata", (True, False))
+def test_download_to_db(httpx_mock, mocker, concurrency, with_metadata):
+    contents = {"file1": b"this is text", "file2": b"\x00\x01" * 100_000}
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    for file_id, content in contents.items():
+        metadata = {"id": file_id}
+        if with_metadata:
+            metadata["size"] = str(len(content))
+            metadata["md5Checksum"] = hashlib.md5(content).hexdigest()
+        httpx_mock.add_response(
+            url="https://www.googleapis.com/drive/v3/files/{}?fields=id%2Csize%2Cmd5Checksum".format(
+                file_id
+            ),
+            json=metadata,
+        )
+        httpx_mock.add_response(
+            url="https://www.googleapis.com/drive/v3/files/{}?alt=media".format(
+                file_id
+            ),
+            content=content,
+        )
+    spool = mocker.spy(google_drive_to_sqlite.utils, "spool")
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(
+            cli,
+            ["download", "file1", "file2", "--to-db", "files.db", "-s"]
+            + ["--concurrency", concurrency],
+        )
+        assert result.exit_code == 0, result.output
+        db = sqlite_utils.Database("files.db")
+        rows = {row["id"]: row for row in db["drive_file_contents"].rows}
+        for file_id, content in contents.items():
+            assert rows[file_id] == {
+                "id": file_id,
+                "md5Checksum": hashlib.md5(content).hexdigest(),
+                "size": len(content),
+                "content": content,
+            }
+        # With size and md5Checksum known the content is streamed straight
+        # into the blob, otherwise it is spooled first to find them out.
+        # Streaming needs Connection.blobopen(), added in Python 3.11.
+        streamed = with_metadata and hasattr(db.conn, "blobopen")
+        assert spool.call_count == (0 if streamed else 2)
+
+
+def test_download_to_db_checksum_mismatch(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?fields=id%2Csize%2Cmd5Checksum",
+        json={"id": "file1", "size": "4", "md5Checksum": "bad"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?alt=media",
+        content=b"text",
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(cli, ["download", "file1", "--to-db", "files.db", "-s"])
+        assert result.exit_code == 1
+        assert result.output == "Error: file1: md5Checksum does not match\n"
+        # The partially written row was rolled back
+        assert sqlite_utils.Database("files.db")["drive_file_contents"].count == 0
+
+
+@pytest.mark.parametrize("concurrency", ("1", "2"))
+def test_download_cache_dir(httpx_mock, concurrency):
+    content = b"this is text"
+    md5_checksum = hashlib.md5(content).hexdigest()
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?fields=id%2Cmd5Checksum%2CmimeType",
+        json={"id": "file1", "md5Checksum": md5_checksum, "mimeType": "text/plain"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?alt=media",
+        content=content,
+        headers={"content-type": "text/plain"},
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        args = ["download", "file1", "--cache-dir", "cache"]
+        args += ["--concurrency", concurrency]
+        result = runner.invoke(cli, args + ["-s"])
+        assert result.exit_code == 0, result.stderr
+        assert open("file1.txt", "rb").read() == content
+        # The cache holds a copy, not a link to the downloaded file
+        cached = os.path.join("cache", md5_checksum)
+        assert open(cached, "rb").read() == content
+        assert not os.path.samefile("file1.txt", cached)
+        # Second time round only the checksum is fetched
+        httpx_mock.reset(assert_all_responses_were_requested=False)
+        httpx_mock.add_response(
+            method="POST",
+            json={"access_token": "atoken"},
+        )
+        httpx_mock.add_response(
+            url="https://www.googleapis.com/drive/v3/files/file1?fields=id%2Cmd5Checksum%2CmimeType",
+            json={"id": "file1", "md5Checksum": md5_checksum, "mimeType": "text/plain"},
+        )
+        result = runner.invoke(cli, args)
+        assert result.exit_code == 0
+        assert result.stderr == "file1.txt is unchanged\n"
+        os.remove("file1.txt")
+        result = runner.invoke(cli, args)
+        assert result.stderr == "Using cached copy of file1.txt\n"
+        assert open("file1.txt", "rb").read() == content
+        assert not [
+            request
+            for request in httpx_mock.get_requests()
+            if "alt" in request.url.params
+        ]
+
+
+def test_download_cache_dir_not_changed_by_later_downloads(httpx_mock):
+    old_content, new_content = b"old content", b"new content"
+    old_md5 = hashlib.md5(old_content).hexdigest()
+    new_md5 = hashlib.md5(new_content).hexdigest()
+    metadata_url = "https://www.googleapis.com/drive/v3/files/file1?fields=id%2Cmd5Checksum%2CmimeType"
+    media_url = "https://www.googleapis.com/drive/v3/files/file1?alt=media"
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        args = ["download", "file1", "--cache-dir", "cache", "-s"]
+        for md5_checksum, content in ((old_md5, old_content), (new_md5, new_content)):
+            httpx_mock.reset(assert_all_responses_were_requested=False)
+            httpx_mock.add_response(method="POST", json={"access_token": "atoken"})
+            httpx_mock.add_response(
+                url=metadata_url,
+                json={
+                    "id": "file1",
+                    "md5Checksum": md5_checksum,
+                    "mimeType": "text/plain",
+                },
+            )
+            httpx_mock.add_response(
+                url=media_url, content=content, headers={"content-type": "text/plain"}
+            )
+            result = runner.invoke(cli, args)
+            assert result.exit_code == 0, result.stderr
+            assert open("file1.txt", "rb").read() == content
+        # Replacing file1.txt left the cached copy of the old content alone
+        assert open(os.path.join("cache", old_md5), "rb").read() == old_content
+        assert open(os.path.join("cache", new_md5), "rb").read() == new_content
+
+
+def test_download_keeps_file_modes(httpx_mock):
+    httpx_mock.add_response(method="POST", json={"access_token": "atoken"})
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?alt=media",
+        content=b"this is text",
+        headers={"content-type": "text/plain"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file2?alt=media",
+        content=b"this is more text",
+        headers={"content-type": "text/plain"},
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        open("expected.txt", "w").close()
+        open("file2.txt", "w").close()
+        os.chmod("file2.txt", 0o640)
+        result = runner.invoke(cli, ["download", "file1", "file2", "-s"])
+        assert result.exit_code == 0, result.stderr
+        # A new file gets the mode open() would give it, a replaced file
+        # keeps its own mode
+        assert os.stat("file1.txt").st_mode == os.stat("expected.txt").st_mode
+        assert stat.S_IMODE(os.stat("file2.txt").st_mode) == 0o640
+        assert open("file2.txt", "rb").read() == b"this is more text"
+
+
+def test_download_cache_dir_ignores_damaged_entries(httpx_mock):
+    content = b"this is text"
+    md5_checksum = hashlib.md5(content).hexdigest()
+    httpx_mock.add_response(method="POST", json={"access_token": "atoken"})
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?fields=id%2Cmd5Checksum%2CmimeType",
+        json={"id": "file1", "md5Checksum": md5_checksum, "mimeType": "text/plain"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?alt=media",
+        content=content,
+        headers={"content-type": "text/plain"},
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        os.mkdir("cache")
+        open(os.path.join("cache", md5_checksum), "wb").write(b"something else")
+        result = runner.invoke(cli, ["download", "file1", "--cache-dir", "cache", "-s"])
+        assert result.exit_code == 0, result.stderr
+        assert open("file1.txt", "rb").read() == content
+        assert open(os.path.join("cache", md5_checksum), "rb").read() == content
+
+
+def test_download_cache_dir_files_db(httpx_mock):
+    content = b"this is text"
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        md5_checksum = hashlib.md5(content).hexdigest()
+        os.mkdir("cache")
+        open(os.path.join("cache", md5_checksum), "wb").write(content)
+        sqlite_utils.Database("files.db")["drive_files"].insert(
+            {"id": "file1", "mimeType": "text/plain", "md5Checksum": md5_checksum}
+        )
+        result = runner.invoke(
+            cli,
+            ["download", "file1", "--cache-dir", "cache", "--files-db", "files.db"],
+        )
+        assert result.exit_code == 0, result.stderr
+        assert open("file1.txt", "rb").read() == content
+        # No API requests were needed at all
+        assert not httpx_mock.get_requests()
+
+
+def test_file_checksums_many_files_db():
+    # More file IDs than older SQLite allows query variables
+    db = sqlite_utils.Database(memory=True)
+    db["drive_files"].insert_all(
+        {"id": str(i), "md5Checksum": "md5-{}".format(i), "mimeType": "text/plain"}
+        for i in range(1500)
+    )
+    file_ids = [str(i) for i in range(1500)]
+    checksums = google_drive_to_sqlite.cli.file_checksums(None, file_ids, db)
+    assert len(checksums) == 1500
+    assert checksums["1499"] == ("md5-1499", "text/plain")
+
+
+def test_download_to_db_reuses_content(httpx_mock):
+    content = b"this is text"
+    md5_checksum = hashlib.md5(content).hexdigest()
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    for file_id in ("file1", "file2"):
+        httpx_mock.add_response(
+            url="https://www.googleapis.com/drive/v3/files/{}?fields=id%2Csize%2Cmd5Checksum".format(
+                file_id
+            ),
+            json={"id": file_id, "size": "12", "md5Checksum": md5_checksum},
+        )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?alt=media",
+        content=content,
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        args = ["download", "file1", "file2", "--to-db", "files.db", "-s"]
+        result = runner.invoke(cli, args)
+        assert result.exit_code == 0, result.output
+        # file2 has the same content so it is copied rather than downloaded
+        assert [
+            request.url.params.get("alt") for request in httpx_mock.get_requests()
+        ] == [
+            None,
+            None,
+            "media",
+            None,
+        ]
+        db = sqlite_utils.Database("files.db")
+        assert [
+            (row["id"], row["content"]) for row in db["drive_file_contents"].rows
+        ] == [("file1", content), ("file2", content)]
+
+
+def test_index_text(httpx_mock):
+    export_url = "https://www.googleapis.com/drive/v3/files/{}/export?mimeType={}"
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url=export_url.format("doc1", "text%2Fplain"),
+        content="\ufeffHello from a document".encode("utf-8"),
+    )
+    httpx_mock.add_response(
+        url=export_url.format("sheet1", "text%2Fcsv"),
+        content=b"name,score\nCleo,5",
+    )
+    httpx_mock.add_response(
+        url=export_url.format("slides1", "text%2Fplain"),
+        status_code=403,
+        content=b"This file is too large to be exported.",
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        db = sqlite_utils.Database("files.db")
+        db["drive_files"].insert_all(
+            [
+                {
+                    "id": "doc1",
+                    "mimeType": "application/vnd.google-apps.document",
+                    "modifiedTime": "2022-01-01T00:00:00.000Z",
+                },
+                {
+                    "id": "sheet1",
+                    "mimeType": "application/vnd.google-apps.spreadsheet",
+                    "modifiedTime": "2022-01-01T00:00:00.000Z",
+                },
+                {
+                    "id": "slides1",
+                    "mimeType": "application/vnd.google-apps.presentation",
+                    "modifiedTime": "2022-01-01T00:00:00.000Z",
+                },
+                {
+                    "id": "image1",
+                    "mimeType": "image/png",
+                    "modifiedTime": "2022-01-01T00:00:00.000Z",
+                },
+            ],
+            pk="id",
+        )
+        result = runner.invoke(cli, ["index-text", "files.db", "-v"])
+        assert result.exit_code == 1
+        assert result.stderr.endswith(
+            "Indexed 2 of 3 files\n"
+            "Failed slides1: 403: This file is too large to be exported.\n"
+            "Error: 1 of 3 files failed\n"
+        )
+        assert list(db["drive_file_text"].rows_where(order_by="id")) == [
+            {
+                "id": "doc1",
+                "modifiedTime": "2022-01-01T00:00:00.000Z",
+                "text": "Hello from a document",
+            },
+            {
+                "id": "sheet1",
+                "modifiedTime": "2022-01-01T00:00:00.000Z",
+                "text": "name,score\nCleo,5",
+            },
+        ]
+        assert [row["id"] for row in db["drive_file_text"].search("cleo")] == ["sheet1"]
+        # Only modified files are exported next time, and deleted files removed
+        db["drive_files"].update("doc1", {"modifiedTime": "2022-02-01T00:00:00.000Z"})
+        db["drive_files"].delete("sheet1")
+        httpx_mock.reset(assert_all_responses_were_requested=False)
+        httpx_mock.add_response(
+            method="POST",
+            json={"access_token": "atoken"},
+        )
+        httpx_mock.add_response(
+            url=export_url.format("doc1", "text%2Fplain"),
+            content=b"Hello again",
+        )
+        httpx_mock.add_response(
+            url=export_url.format("slides1", "text%2Fplain"),
+            content=b"Slide text",
+        )
+        result = runner.invoke(cli, ["index-text", "files.db", "-v"])
+        assert result.exit_code == 0
+        assert result.stderr.endswith("Indexed 2 of 2 files\n")
+        assert [
+            (row["id"], row["text"])
+            for row in db["drive_file_text"].rows_where(order_by="id")
+        ] == [("doc1", "Hello again"), ("slides1", "Slide text")]
+        assert [row["id"] for row in db["drive_file_text"].search("again")] == ["doc1"]
+        result = runner.invoke(cli, ["index-text", "files.db", "-v"])
+        assert result.stderr == "Nothing to index\n"
+
+
+def test_save_files_and_folders_folder_closure():
+    db = sqlite_utils.Database(memory=True)
+    folder_type = "application/vnd.google-apps.folder"
+
+    def folder(id, name, parent, version="1"):
+        return {
+            "id": id,
+            "name": name,
+            "mimeType": folder_type,
+            "parents": [parent] if parent else [],
+            "version": version,
+        }
+
+    def closure():
+        return {
+            (row["ancestor"], row["descendant"]): row["depth"]
+            for row in db["drive_folder_closure"].rows
+        }
+
+    def paths():
+        return {row["id"]: row["_path"] for row in db["drive_folders"].rows}
+
+    # Children arrive before their parents, one per chunk
+    save_files_and_folders(
+        db,
+        [folder("c", "C", "b"), folder("b", "B", "a"), folder("a", "A", None)],
+        batch_size=1,
+        fields=["id", "name", "mimeType", "parents", "version"],
+    )
+    assert closure() == {
+        ("a", "a"): 0,
+        ("b", "b"): 0,
+        ("c", "c"): 0,
+        ("a", "b"): 1,
+        ("b", "c"): 1,
+        ("a", "c"): 2,
+    }
+    assert paths() == {"a": "A", "b": "A/B", "c": "A/B/C"}
+    # Subtree queries are lookups on the closure table
+    assert [
+        row["id"]
+        for row in db.query(
+            "select id from drive_folders where id in (select descendant"
+            " from drive_folder_closure where ancestor = 'b') order by id"
+        )
+    ] == ["b", "c"]
+    # Move b (and c with it) to a new top-level folder d, and rename a
+    save_files_and_folders(
+        db,
+        [
+            folder("d", "D", None),
+            folder("b", "B", "d", version="2"),
+            folder("a", "A2", None, version="2"),
+        ],
+        fields=["id", "name", "mimeType", "parents", "version"],
+    )
+    assert closure() == {
+        ("a", "a"): 0,
+        ("b", "b"): 0,
+        ("c", "c"): 0,
+        ("d", "d"): 0,
+        ("d", "b"): 1,
+        ("b", "c"): 1,
+        ("d", "c"): 2,
+    }
+    assert paths() == {"a": "A2", "b": "D/B", "c": "D/B/C", "d": "D"}
+
+
+def test_save_files_and_folders_backfills_folder_closure():
+    # A database saved before drive_folder_closure and _path existed
+    db = sqlite_utils.Database(memory=True)
+    folder_type = "application/vnd.google-apps.folder"
+    folders = [
+        {
+            "id": id,
+            "name": name,
+            "parents": [parent],
+            "version": "1",
+            "modifiedTime": "2022-01-01T00:00:00.000Z",
+        }
+        for id, name, parent in (("c", "C", "b"), ("b", "B", "a"), ("a", "A", "root"))
+    ]
+    for table in ("drive_users", "drive_folders", "drive_files"):
+        db[table].create({"id": str}, pk="id")
+    db["drive_folders"].insert_all(
+        [
+            dict(
+                folder,
+                mimeType=folder_type,
+                _parent=folder["parents"][0],
+                _owner=None,
+                lastModifyingUser=None,
+            )
+            for folder in folders
+        ],
+        alter=True,
+    )
+    # Saving the same, unchanged folders again fills in the hierarchy
+    counts = save_files_and_folders(
+        db,
+        [dict(folder, mimeType=folder_type) for folder in folders],
+        fields=["id", "name", "mimeType", "parents", "version", "modifiedTime"],
+    )
+    assert counts == {"inserted": 0, "updated": 0, "unchanged": 3}
+    assert {
+        (row["ancestor"], row["descendant"]): row["depth"]
+        for row in db["drive_folder_closure"].rows
+    } == {
+        ("root", "root"): 0,
+        ("a", "a"): 0,
+        ("b", "b"): 0,
+        ("c", "c"): 0,
+        ("root", "a"): 1,
+        ("a", "b"): 1,
+        ("b", "c"): 1,
+        ("root", "b"): 2,
+        ("a", "c"): 2,
+        ("root", "c"): 3,
+    }
+    assert {row["id"]: row["_path"] for row in db["drive_folders"].rows} == {
+        "a": "A",
+        "b": "A/B",
+        "c": "A/B/C",
+    }
+
+
+def test_files_stats(httpx_mock, mocker):
+    mocker.patch("google_drive_to_sqlite.utils.sleep")
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        status_code=429, headers={"Retry-After": "1"}, json={"error": {}}
+    )
+    httpx_mock.add_response(
+        json={
+            "nextPageToken": "next",
+            "files": [
+                {
+                    "id": "1",
+                    "name": "one.txt",
+                    "owners": [{"permissionId": "user1", "displayName": "User"}],
+                },
+                {"id": "2", "name": "two.txt"},
+            ],
+        },
+    )
+    httpx_mock.add_response(
+        json={"files": [{"id": "3", "name": "three.txt"}]},
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(cli, ["files", "test.db", "--stats"])
+        assert result.exit_code == 0, result.stderr
+        stats = json.loads(result.stderr)
+        assert stats["requests"] == 4
+        assert stats["requests_by_endpoint"] == {
+            "GET /drive/v3/files": {"200": 2, "429": 1},
+            "POST /oauth2/v4/token": {"200": 1},
+        }
+        assert stats["retries"] == 1
+        assert stats["token_refreshes"] == 1
+        assert stats["bytes_received"] > 0
+        assert set(stats["latency"]) == {"p50", "p90", "p99", "max"}
+        assert stats["rows_written"] == {
+            "drive_users": 1,
+            "drive_folders": 0,
+            "drive_files": 3,
+        }
+        assert stats["rows_per_second"] > 0
+        assert set(stats["phases"]) == {"fetch", "parse", "normalize", "write"}
+
+
+def test_download_stats(httpx_mock):
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/1Xdqfeoi8B8YJJR0y-_oQlHYpjHHzD5a-?alt=media",
+        content=b"this is text",
+        headers={"content-type": "text/plain"},
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(
+            cli,
+            ["download", "1Xdqfeoi8B8YJJR0y-_oQlHYpjHHzD5a-", "-s", "--stats"],
+        )
+        assert result.exit_code == 0
+        stats = json.loads(result.stderr)
+        # File IDs are replaced so requests are grouped by endpoint
+        assert stats["requests_by_endpoint"] == {
+            "GET /drive/v3/files/{id}": {"200": 1},
+            "POST /oauth2/v4/token": {"200": 1},
+        }
+        assert stats["bytes_received"] == len(b"this is text") + len(
+            b'{"access_token": "atoken"}'
+        )
+
+
+def test_stats_percentiles():
+    stats = Stats()
+    for latency in range(1, 101):
+        stats.latencies.append(latency / 100)
+    assert stats.as_dict()["latency"] == {
+        "p50": 0.5,
+        "p90": 0.9,
+        "p99": 0.99,
+        "max": 1.0,
+    }
+    assert Stats().as_dict()["latency"] is None
+
+
+def test_download_retries_rate_limit(httpx_mock, mocker):
+    sleep = mocker.patch("google_drive_to_sqlite.utils.sleep")
+    httpx_mock.add_response(
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    url = "https://www.googleapis.com/drive/v3/files/1Xdqfeoi8B8YJJR0y-_oQlHYpjHHzD5a-?alt=media"
+    httpx_mock.add_response(
+        url=url,
+        status_code=403,
+        json={"error": {"errors": [{"reason": "userRateLimitExceeded"}]}},
+        headers={"Retry-After": "3"},
+    )
+    httpx_mock.add_response(
+        url=url, content=b"this is text", headers={"content-type": "text/plain"}
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(
+            cli, ["download", "1Xdqfeoi8B8YJJR0y-_oQlHYpjHHzD5a-", "-s"]
+        )
+        assert result.exit_code == 0
+        assert open("1Xdqfeoi8B8YJJR0y-_oQlHYpjHHzD5a-.txt").read() == "this is text"
+    sleep.assert_any_call(3.0)
+
+
+def test_profile(httpx_mock):
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/oauth2/v4/token",
+        method="POST",
+        json={"access_token": "atoken"},
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/about?fields=*",
+        method="GET",
+        json={"kind": "drive#about"},
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(
+            cli,
+            [
+                "--profile",
+                "get.prof",
+                "get",
+                "https://www.googleapis.com/drive/v3/about?fields=*",
+            ],
+        )
+        assert result.exit_code == 0
+        assert json.loads(result.output) == {"kind": "drive#about"}
+        functions = {name for _, _, name in pstats.Stats("get.prof").stats}
+        assert "get" in functions
+
+
+@pytest.mark.parametrize("command", ("download", "export"))
+@pytest.mark.parametrize("output", ("mine.txt", "-"))
+def test_download_output_with_concurrency(httpx_mock, command, output):
+    httpx_mock.add_response(method="POST", json={"access_token": "atoken"})
+    httpx_mock.add_response(
+        method="GET", content=b"this is text", headers={"content-type": "text/plain"}
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        args = [command] + (["txt"] if command == "export" else [])
+        args += ["file1", "-o", output, "--concurrency", "2", "-s"]
+        result = runner.invoke(cli, args)
+        assert result.exit_code == 0, result.stderr
+        if output == "-":
+            assert result.stdout == "this is text"
+        else:
+            assert open(output).read() == "this is text"
+        assert not os.path.exists("file1.txt")
+        assert not os.path.exists("file1-export.txt")
+
+
+@pytest.mark.parametrize("concurrency,expected", ((1, 20), (30, 30)))
+def test_connection_pool_fits_concurrency(httpx_mock, mocker, concurrency, expected):
+    httpx_mock.add_response(method="POST", json={"access_token": "atoken"})
+    httpx_mock.add_response(
+        method="GET", content=b"this is text", headers={"content-type": "text/plain"}
+    )
+    limits = mocker.spy(google_drive_to_sqlite.utils.httpx, "Limits")
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(
+            cli, ["download", "file1", "-s", "--concurrency", str(concurrency)]
+        )
+        assert result.exit_code == 0, result.output
+    assert limits.call_args.kwargs["max_connections"] == expected
+    assert limits.call_args.kwargs["max_keepalive_connections"] == expected
+
+
+def test_async_stream_retries_rate_limit(httpx_mock, mocker):
+    sleep = mocker.patch("google_drive_to_sqlite.utils.asyncio.sleep")
+    httpx_mock.add_response(method="POST", json={"access_token": "atoken"})
+    httpx_mock.add_response(
+        method="GET",
+        status_code=429,
+        headers={"Retry-After": "2"},
+        json={"error": {"code": 429}},
+    )
+    httpx_mock.add_response(method="GET", content=b"this is text")
+
+    async def run():
+        async with AsyncAPIClient("rtoken", "id", "secret") as client:
+            async with client.stream(
+                "GET", "https://www.googleapis.com/drive/v3/files/file1?alt=media"
+            ) as response:
+                return response.status_code, await response.aread()
+
+    assert asyncio.run(run()) == (200, b"this is text")
+    sleep.assert_any_call(2.0)
+
+
+def test_download_to_db_concurrent_failures(httpx_mock):
+    httpx_mock.add_response(method="POST", json={"access_token": "atoken"})
+    for file_id in ("file1", "file2"):
+        httpx_mock.add_response(
+            url="https://www.googleapis.com/drive/v3/files/{}?fields=id%2Csize%2Cmd5Checksum".format(
+                file_id
+            ),
+            json={"id": file_id},
+        )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file1?alt=media",
+        status_code=404,
+        content=b"File not found",
+    )
+    httpx_mock.add_response(
+        url="https://www.googleapis.com/drive/v3/files/file2?alt=media",
+        content=b"this is text",
+    )
+    runner = CliRunner(mix_stderr=False)
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        result = runner.invoke(
+            cli,
+            ["download", "file1", "file2", "--to-db", "files.db"]
+            + ["--concurrency", "2", "-s"],
+        )
+        assert result.exit_code == 1
+        assert result.stderr == (
+            "Failed file1: File not found\nError: 1 of 2 files failed\n"
+        )
+        # The other download was still saved
+        db = sqlite_utils.Database("files.db")
+        assert [row["id"] for row in db["drive_file_contents"].rows] == ["file2"]
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        ["files", "test.db", "--folder", "folder1"],
+        ["download", "file1"],
+        ["export", "pdf", "file1"],
+        ["index-text", "test.db"],
+    ),
+)
+def test_concurrency_must_be_positive(args):
+    result = CliRunner().invoke(cli, args + ["--concurrency", "0"])
+    assert result.exit_code == 2
+    assert "Invalid value for '--concurrency': 0 is not in the range x>=1." in (
+        result.output
+    )
+
+
+def test_batch_size_must_be_positive():
+    result = CliRunner().invoke(cli, ["files", "test.db", "--batch-size", "0"])
+    assert result.exit_code == 2
+    assert "Invalid value for '--batch-size': 0 is not in the range x>=1." in (
+        result.output
+    )
+
+
+def test_paginate_files_client_without_stats():
+    class Client:
+        # A minimal client, without the stats attribute of APIClient
+        def get(self, url, params=None):
+            return httpx.Response(200, json={"files": [{"id": "1"}]})
+
+    assert list(paginate_files(Client())) == [{"id": "1"}]
+
+
+class PagedFolderClient:
+    # A client listing a folder with one file on each of 50 pages
+    def __init__(self):
+        self.page_tokens = []
+
+    def get(self, url, params=None):
+        page_token = params.get("pageToken")
+        self.page_tokens.append(page_token)
+        page = int(page_token or 1)
+        data = {"files": [{"id": "file{}".format(page), "mimeType": "doc"}]}
+        if page < 50:
+            data["nextPageToken"] = str(page + 1)
+        return httpx.Response(200, json=data)
+
+
+def test_files_in_folder_recursive_streams_pages():
+    client = PagedFolderClient()
+    state = CrawlState({"folder": "folder1", "q": ""})
+    files = files_in_folder_recursive(
+        client, "folder1", ["id", "mimeType", "parents"], state=state
+    )
+    # Files are yielded as each page arrives, with the worker only able to
+    # get a couple of pages ahead
+    assert next(files)["id"] == "file1"
+    assert len(client.page_tokens) <= 3
+    assert [next(files)["id"], next(files)["id"]] == ["file2", "file3"]
+    # The checkpoint records the page that is being yielded
+    assert state.page_tokens == {"folder1": "3"}
+    files.close()
+    db = sqlite_utils.Database(memory=True)
+    with db.conn:
+        state.save(db)
+    state = CrawlState.load(db)
+    assert state.frontier == ["folder1"]
+    assert state.page_tokens == {"folder1": "3"}
+    # Resuming starts from that page rather than the start of the folder
+    client = PagedFolderClient()
+    ids = [
+        file["id"]
+        for file in files_in_folder_recursive(
+            client, "folder1", ["id", "mimeType", "parents"], state=state
+        )
+    ]
+    assert ids == ["file{}".format(page) for page in range(3, 51)]
+    assert client.page_tokens[0] == "3"
+    assert state.page_tokens == {}
+
+
+def test_files_in_folder_recursive_async_streams_pages():
+    paged = PagedFolderClient()
+
+    class AsyncClient:
+        async def get(self, url, params=None):
+            return paged.get(url, params)
+
+    async def first_file():
+        files = files_in_folder_recursive_async(
+            AsyncClient(), "folder1", ["id", "mimeType", "parents"]
+        )
+        try:
+            return await files.__anext__()
+        finally:
+            await files.aclose()
+
+    assert asyncio.run(first_file())["id"] == "file1"
+    assert len(paged.page_tokens) < 50
+
+
+def test_index_text_requires_modified_time():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(json.dumps(AUTH_JSON))
+        sqlite_utils.Database("files.db")["drive_files"].insert(
+            {"id": "doc1", "mimeType": "application/vnd.google-apps.document"}
+        )
+        result = runner.invoke(cli, ["index-text", "files.db"])
+        assert result.exit_code == 1
+        assert result.output == (
+            "Error: drive_files has no modifiedTime column, which is needed to "
+            "find files to index - run the files command with --fields +modifiedTime\n"
+        )